@@ -0,0 +1,360 @@
+#!/usr/bin/python3
+
+import sys, time
+import numpy as np
+import engine
+
+# Steps many games of the same map in lockstep. The state of all games lives
+# in NumPy arrays with the game as first axis, so every rule is applied to all
+# games at once instead of object by object. The rules are those of
+# engine.Game, and check() plays random actions on both to make sure.
+#
+# Lighthouses are numbered in map order (GameConfig.lighthouses). Connections
+# and keys are boolean masks over those numbers. Triangles are not stored:
+# they are exactly the triangles of the connection graph, because a
+# connection is only ever removed along with every triangle on it. Their
+# scores are kept per player in tri_score.
+#
+# An action is a row (command, a, b):
+#   PASS
+#   MOVE     a, b = x, y step
+#   ATTACK   a = energy
+#   CONNECT  a = destination lighthouse number
+
+PASS, MOVE, ATTACK, CONNECT = 0, 1, 2, 3
+
+def _orient(a, b, c):
+    return (b[..., 0] - a[..., 0]) * (c[..., 1] - a[..., 1]) - (c[..., 0] - a[..., 0]) * (b[..., 1] - a[..., 1])
+
+class BatchGame(object):
+    DECAY = 10
+
+    def __init__(self, cfg, games, numplayers=None):
+        if numplayers is None:
+            numplayers = len(cfg.players)
+        assert numplayers <= len(cfg.players)
+        # The reference game provides the precomputed tables
+        self._ref = engine.Game(cfg, numplayers)
+        self.games = games
+        self.numplayers = numplayers
+        self.lighthouses = list(cfg.lighthouses)
+        island = self._ref.island
+        self.h, self.w = island.h, island.w
+        self.mask = island.mask
+        self.regen = self._ref.regen
+        self.blocked = self._ref.blocked
+        self.max_energy = island.MAX_ENERGY
+
+        L = len(self.lighthouses)
+        points = np.array(self.lighthouses, dtype=np.int64).reshape(-1, 2)
+        self.lh_at = np.full((self.h, self.w), -1, dtype=int)
+        self.lh_at[points[:, 1], points[:, 0]] = np.arange(L)
+        self._points = points
+        # Cell counts of triangles by sorted lighthouse numbers, filled in as
+        # triangles are first formed
+        self._weights = {}
+
+        n, P = games, numplayers
+        start = np.array(cfg.players[:P], dtype=int).reshape(-1, 2)
+        self.energy = np.zeros((n, self.h, self.w), dtype=np.int64)
+        self.x = np.tile(start[:, 0], (n, 1))
+        self.y = np.tile(start[:, 1], (n, 1))
+        self.player_energy = np.zeros((n, P), dtype=np.int64)
+        self.score = np.zeros((n, P), dtype=np.int64)
+        self.keys = np.zeros((n, P, L), dtype=bool)
+        self.owner = np.full((n, L), -1, dtype=int)
+        self.lh_energy = np.zeros((n, L), dtype=np.int64)
+        self.conns = np.zeros((n, L, L), dtype=bool)
+        self.tri_score = np.zeros((n, P), dtype=np.int64)
+
+    def _weight(self, i, j, k):
+        key = tuple(sorted((int(i), int(j), int(k))))
+        if key not in self._weights:
+            tri = tuple(self.lighthouses[v] for v in key)
+            self._weights[key] = self._ref._tri_cells(tri).count
+        return self._weights[key]
+
+    def _crossing(self, g, o, d):
+        # Whether the new edge o[k]-d[k] crosses a connection of game g[k]
+        # (see geom.intersect). Only the live connections of those games are
+        # tested.
+        k, i, j = np.nonzero(np.triu(self.conns[g], 1))
+        pts = self._points
+        a, b, c, e = pts[o[k]], pts[d[k]], pts[i], pts[j]
+        cross = ((_orient(a, b, c) * _orient(a, b, e) < 0) &
+                 (_orient(c, e, a) * _orient(c, e, b) < 0))
+        return np.bincount(k[cross], minlength=len(g)) > 0
+
+    def _unlink(self, g, i):
+        # Drops the connections and triangles of lighthouse i[k] in game g[k]
+        nb = self.conns[g, i]
+        tris = nb[:, :, None] & nb[:, None, :] & np.triu(self.conns[g], 1)
+        lost = np.zeros(len(g), dtype=np.int64)
+        for k, a, b in zip(*np.nonzero(tris)):
+            lost[k] += self._weight(i[k], a, b)
+        np.subtract.at(self.tri_score, (g, self.owner[g, i]), lost)
+        self.conns[g, i, :] = False
+        self.conns[g, :, i] = False
+
+    def pre_round(self):
+        self.energy += self.regen
+        np.minimum(self.energy, self.max_energy, out=self.energy)
+        games = np.arange(self.games)[:, None]
+        at = self.lh_at[self.y, self.x]
+        g, p = np.nonzero(at >= 0)
+        self.keys[g, p, at[g, p]] = True
+        # Players on the same cell split its energy
+        count = ((self.x[:, :, None] == self.x[:, None, :]) &
+                 (self.y[:, :, None] == self.y[:, None, :])).sum(2)
+        self.player_energy += self.energy[games, self.y, self.x] // count
+        self.energy[games, self.y, self.x] = 0
+        owned = self.owner >= 0
+        self.lh_energy[owned] -= self.DECAY
+        dead = owned & (self.lh_energy <= 0)
+        self.lh_energy[dead] = 0
+        for i in np.nonzero(dead.any(0))[0]:
+            g = np.nonzero(dead[:, i])[0]
+            self._unlink(g, np.full(len(g), i))
+        self.owner[dead] = -1
+
+    def play(self, slot, actions):
+        # Applies one action per game for player `slot`; returns which
+        # succeeded
+        actions = np.asarray(actions, dtype=np.int64).reshape(self.games, 3)
+        cmd, a, b = actions[:, 0], actions[:, 1], actions[:, 2]
+        p = slot
+        ok = cmd == PASS
+
+        g = np.nonzero((cmd == MOVE) & (np.abs(a) <= 1) & (np.abs(b) <= 1))[0]
+        nx, ny = self.x[g, p] + a[g], self.y[g, p] + b[g]
+        inside = (nx >= 0) & (nx < self.w) & (ny >= 0) & (ny < self.h)
+        g, nx, ny = g[inside], nx[inside], ny[inside]
+        land = self.mask[ny, nx]
+        g, nx, ny = g[land], nx[land], ny[land]
+        self.x[g, p] = nx
+        self.y[g, p] = ny
+        ok[g] = True
+
+        at = self.lh_at[self.y[:, p], self.x[:, p]]
+        g = np.nonzero((cmd == ATTACK) & (at >= 0) & (a >= 0))[0]
+        if len(g):
+            i = at[g]
+            strength = np.minimum(a[g], self.player_energy[g, p])
+            self.player_energy[g, p] -= strength
+            other = (self.owner[g, i] >= 0) & (self.owner[g, i] != p)
+            d = np.where(other, np.minimum(self.lh_energy[g, i], strength), 0)
+            self.lh_energy[g, i] -= d
+            dead = other & (self.lh_energy[g, i] <= 0)
+            if dead.any():
+                self._unlink(g[dead], i[dead])
+                self.owner[g[dead], i[dead]] = -1
+            strength -= d
+            s = strength > 0
+            self.owner[g[s], i[s]] = p
+            self.lh_energy[g[s], i[s]] += strength[s]
+            ok[g] = True
+
+        L = len(self.lighthouses)
+        g = np.nonzero((cmd == CONNECT) & (at >= 0) & (a >= 0) & (a < L))[0]
+        if len(g):
+            o, d = at[g], a[g]
+            good = ((o != d) & (self.owner[g, o] == p) & (self.owner[g, d] == p) &
+                    self.keys[g, p, d] & ~self.conns[g, o, d] & ~self.blocked[o, d])
+            g, o, d = g[good], o[good], d[good]
+            clear = ~self._crossing(g, o, d)
+            g, o, d = g[clear], o[clear], d[clear]
+            self.keys[g, p, d] = False
+            self.conns[g, o, d] = self.conns[g, d, o] = True
+            for k, t in zip(*np.nonzero(self.conns[g, o] & self.conns[g, d])):
+                self.tri_score[g[k], p] += self._weight(o[k], d[k], t)
+            ok[g] = True
+        return ok
+
+    def post_round(self):
+        degree = self.conns.sum(2)
+        for p in range(self.numplayers):
+            mine = self.owner == p
+            # Each connection is counted at both ends, which makes the 2 points
+            self.score[:, p] += 2 * mine.sum(1) + (degree * mine).sum(1)
+        self.score += self.tri_score
+
+def command(bg, action):
+    # The engine.Game command for a BatchGame action
+    cmd, a, b = (int(v) for v in action)
+    if cmd == PASS:
+        return {"command": "pass"}
+    elif cmd == MOVE:
+        return {"command": "move", "x": a, "y": b}
+    elif cmd == ATTACK:
+        return {"command": "attack", "energy": a}
+    elif cmd == CONNECT:
+        dest = bg.lighthouses[a] if 0 <= a < len(bg.lighthouses) else (0, 0)
+        return {"command": "connect", "destination": list(dest)}
+    return {"command": "fly"}
+
+def home_triangles(bg, rng):
+    # One random triangle of lighthouses per game, among the smallest ones
+    # whose connections are not blocked by a lighthouse, or None if the map
+    # has none
+    L = len(bg.lighthouses)
+    i, j, k = (a.ravel() for a in np.meshgrid(*[np.arange(L)] * 3, indexing="ij"))
+    valid = (i < j) & (j < k) & ~bg.blocked[i, j] & ~bg.blocked[j, k] & ~bg.blocked[i, k]
+    if not valid.any():
+        return None
+    i, j, k = i[valid], j[valid], k[valid]
+    points = np.array(bg.lighthouses, dtype=np.int64)
+    size = np.max([np.abs(points[u] - points[v]).max(1) for u, v in ((i, j), (j, k), (i, k))], 0)
+    small = size <= 1.5 * size.min()
+    tris = np.stack([i[small], j[small], k[small]], 1)
+    return tris[rng.integers(0, len(tris), bg.games)]
+
+def _retarget(bg, rng, targets, homes, which):
+    # New targets for the games in `which`: a corner of the home triangle
+    # most of the time, any lighthouse otherwise
+    count = int(which.sum())
+    new = rng.integers(0, len(bg.lighthouses), count)
+    if homes is not None:
+        home = rng.random(count) < 0.9
+        corners = homes[which][np.arange(count), rng.integers(0, 3, count)]
+        new[home] = corners[home]
+    targets[which] = new
+
+def random_actions(bg, slot, rng, targets, homes=None):
+    # Mostly sensible actions, so that games build connections and triangles,
+    # mixed with invalid ones. Players head for a target lighthouse, take it
+    # and connect it, then pick another target. With homes (see
+    # home_triangles) targets are mostly corners of a small triangle, so that
+    # triangles form even when many players fight over the map
+    n, L = bg.games, len(bg.lighthouses)
+    games = np.arange(n)
+    _retarget(bg, rng, targets, homes, rng.random(n) < 0.05)
+    tx, ty = np.array(bg.lighthouses).reshape(-1, 2)[targets].T
+    x, y = bg.x[:, slot], bg.y[:, slot]
+    at = bg.lh_at[y, x]
+    actions = np.zeros((n, 3), dtype=np.int64)
+    actions[:, 0] = MOVE
+    actions[:, 1] = np.sign(tx - x)
+    actions[:, 2] = np.sign(ty - y)
+    # Steps into water become random steps, to get around it
+    nx, ny = x + actions[:, 1], y + actions[:, 2]
+    water = ~bg.mask[np.clip(ny, 0, bg.h - 1), np.clip(nx, 0, bg.w - 1)]
+    wander = water | (rng.random(n) < (0.3 if homes is None else 0.1))
+    actions[wander, 1:] = rng.integers(-1, 2, (wander.sum(), 2))
+    # Players stop at their target, and sometimes at other lighthouses
+    here = (at >= 0) & ((at == targets) | (rng.random(n) < 0.2))
+    mine = here & (bg.owner[games, np.maximum(at, 0)] == slot)
+    attack = here & (~mine | (rng.random(n) < 0.2))
+    actions[attack, 0] = ATTACK
+    full = (at == targets) | (rng.random(n) < 0.7)
+    actions[attack, 1] = np.where(full, bg.player_energy[:, slot], rng.integers(0, 50, n))[attack]
+    # Lighthouses that could be connected to from here
+    ready = (bg.keys[:, slot] & (bg.owner == slot) & ~bg.blocked[np.maximum(at, 0)] &
+             ~bg.conns[games, np.maximum(at, 0)])
+    ready[games, np.maximum(at, 0)] = False
+    pick = rng.random((n, L)) + 2 * ready
+    connect = mine & (rng.random(n) < 0.7)
+    actions[connect, 0] = CONNECT
+    actions[connect, 1] = pick.argmax(1)[connect]
+    # Move on once nothing is left to connect
+    done = mine & ~ready.any(1)
+    _retarget(bg, rng, targets, homes, done | (here & (rng.random(n) < 0.1)))
+    odd = rng.random(n) < 0.02
+    actions[odd] = np.stack([rng.integers(0, 5, n), rng.integers(-2, L + 2, n),
+                             rng.integers(-2, 3, n)], 1)[odd]
+    return actions
+
+def _compare(bg, n, game, where):
+    index = dict((pos, i) for i, pos in enumerate(bg.lighthouses))
+    L = len(bg.lighthouses)
+    conns = np.zeros((L, L), dtype=bool)
+    for pair in game.conns:
+        i, j = (index[pos] for pos in pair)
+        conns[i, j] = conns[j, i] = True
+    tris = set(tuple(sorted(index[pos] for pos in tri)) for tri in game.tris)
+    c = bg.conns[n]
+    batch_tris = set((i, j, k) for i in range(L) for j in range(i + 1, L) for k in range(j + 1, L)
+                     if c[i, j] and c[j, k] and c[i, k])
+    checks = [
+        ("energy", np.array_equal(bg.energy[n], game.island.energy_array())),
+        ("positions", [(int(x), int(y)) for x, y in zip(bg.x[n], bg.y[n])] ==
+                      [p.pos for p in game.players]),
+        ("player energy", bg.player_energy[n].tolist() == [p.energy for p in game.players]),
+        ("scores", bg.score[n].tolist() == [p.score for p in game.players]),
+        ("keys", [set(np.nonzero(k)[0].tolist()) for k in bg.keys[n]] ==
+                 [set(index[pos] for pos in p.keys) for p in game.players]),
+        ("owners", bg.owner[n].tolist() == [-1 if game.lighthouses[pos].owner is None
+                                             else game.lighthouses[pos].owner
+                                             for pos in bg.lighthouses]),
+        ("lighthouse energy", bg.lh_energy[n].tolist() == [game.lighthouses[pos].energy
+                                                           for pos in bg.lighthouses]),
+        ("connections", np.array_equal(conns, bg.conns[n])),
+        ("triangles", tris == batch_tris),
+    ]
+    for name, same in checks:
+        if not same:
+            raise engine.GameError("Game %d: %s differ %s" % (n, name, where))
+
+def check(cfg, games=16, rounds=300, numplayers=None, seed=0):
+    # Conformance mode: plays the same random actions on a BatchGame and on
+    # one engine.Game per game, and compares every result and every state
+    rng = np.random.default_rng(seed)
+    bg = BatchGame(cfg, games, numplayers)
+    refs = [engine.Game(cfg, bg.numplayers) for i in range(games)]
+    targets = [rng.integers(0, len(bg.lighthouses), games) for p in range(bg.numplayers)]
+    homes = [home_triangles(bg, rng) for p in range(bg.numplayers)]
+    # Only the first players of each game act, the others pass. Crowded
+    # games fight over every lighthouse and seldom keep a triangle, so the
+    # number of active players varies from game to game, log-uniformly from
+    # 1 to all of them
+    active = np.arange(bg.numplayers) < (bg.numplayers + 1) ** rng.random((games, 1)) - 1
+    # Most connections in one game at once, and triangles formed in total
+    stats = {"actions": 0, "failed": 0, "connections": 0, "triangles": 0}
+    tris = [set() for game in refs]
+    for round in range(rounds):
+        bg.pre_round()
+        for game in refs:
+            game.pre_round()
+        for slot in range(bg.numplayers):
+            actions = random_actions(bg, slot, rng, targets[slot], homes[slot])
+            actions[~active[:, slot]] = PASS
+            ok = bg.play(slot, actions)
+            for n, game in enumerate(refs):
+                try:
+                    game.play(game.players[slot], command(bg, actions[n]))
+                    success = True
+                except engine.MoveError:
+                    success = False
+                if success != ok[n]:
+                    raise engine.GameError("Game %d: action %r %s in round %d" % (
+                        n, actions[n].tolist(), "failed" if success else "succeeded", round))
+            stats["actions"] += games
+            stats["failed"] += int((~ok).sum())
+        bg.post_round()
+        for n, game in enumerate(refs):
+            game.post_round()
+            _compare(bg, n, game, "after round %d" % round)
+            stats["triangles"] += len(set(game.tris) - tris[n])
+            tris[n] = set(game.tris)
+        stats["connections"] = max(stats["connections"], int(bg.conns.sum((1, 2)).max()) // 2)
+    return stats
+
+if __name__ == "__main__":
+    # batch.py <map> [games] [rounds]: conformance check and timing
+    cfg = engine.GameConfig(sys.argv[1])
+    games = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+    st = time.time()
+    stats = check(cfg, games, rounds)
+    print("conformance OK in %.1fs: %r" % (time.time() - st, stats))
+    bg = BatchGame(cfg, 1024)
+    rng = np.random.default_rng(1)
+    actions = [np.zeros((bg.games, 3), dtype=np.int64) for p in range(bg.numplayers)]
+    st = time.time()
+    for round in range(100):
+        bg.pre_round()
+        for slot in range(bg.numplayers):
+            actions[slot][:, 0] = MOVE
+            actions[slot][:, 1:] = rng.integers(-1, 2, (bg.games, 2))
+            bg.play(slot, actions[slot])
+        bg.post_round()
+    print("%d games x 100 rounds: %.0f game rounds/s" % (bg.games, bg.games * 100 / (time.time() - st)))
@@ -0,0 +1,383 @@
+#!/usr/bin/python3
+
+import os, sys, gc, time, json, random, argparse, platform, tracemalloc
+import engine, botplayer, geom
+
+# Engine benchmarks. A map is generated from a seed (or read from a file), a
+# scripted policy plays it once to record an action trace, and the trace is
+# then replayed on a fresh game while each phase is timed on its own:
+#
+#   setup       GameConfig parsing and Game construction
+#   pre_round   Game.pre_round
+#   decay       Lighthouse.decay, on a copy of the game every DECAY_SAMPLE rounds
+#   snapshot    Game.lighthouse_snapshot, rebuilding the lighthouses touched
+#               since the previous turn
+#   state       BotPlayer turn message, full and delta, and in-process turn_state,
+#               on an up-to-date snapshot
+#   view        Island.get_view
+#   play_*      Game.play, per command (play_connect is Game.connect)
+#   post_round  Game.post_round
+#   render      geom.render and geom.render_mask on nearby lighthouse triples
+#   gameview    GameView.update after every turn (needs pygame; small maps only)
+#
+# Replaying the same trace gives the same game every time, so runs on the
+# same arguments are comparable. Results are printed as JSON.
+#
+# With --memory N, N games are built on the map instead and the trace is
+# replayed on each; the report has the bytes allocated for the map data all
+# games share and the bytes per game, fresh and after the trace:
+#
+#   bench.py --map maps/square_xl.txt -p 16 --memory 1000
+
+PLAYER_CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+DECAY_SAMPLE = 10
+RENDER_SAMPLES = 200
+# GameView draws CELL pixels per cell into one surface
+GAMEVIEW_MAX_CELLS = 200 * 200
+
+def generate_map(width, height, lighthouses=None, density=0.0005, players=2,
+                 water=0.2, seed=0):
+    # Map text with a water border and rectangular lakes covering about
+    # `water` of the inside. Without an explicit count, lighthouses are placed
+    # at `density` per land cell.
+    if not 3 <= width <= 1000 or not 3 <= height <= 1000:
+        raise engine.GameError("Map size must be between 3x3 and 1000x1000")
+    if not 1 <= players <= len(PLAYER_CHARS):
+        raise engine.GameError("Player count must be between 1 and %d" % len(PLAYER_CHARS))
+    if not 0 <= water < 1:
+        raise engine.GameError("Water fraction must be in [0, 1)")
+    rng = random.Random(seed)
+    rows = [["#"] * width] + [["#"] + [" "] * (width - 2) + ["#"] for y in range(height - 2)] + [["#"] * width]
+    inside = (width - 2) * (height - 2)
+    wet = 0
+    side = max(1, min(width, height) // 8)
+    while wet < water * inside:
+        w, h = rng.randint(1, side), rng.randint(1, side)
+        x0, y0 = rng.randint(1, width - 2), rng.randint(1, height - 2)
+        for y in range(y0, min(y0 + h, height - 1)):
+            for x in range(x0, min(x0 + w, width - 1)):
+                if rows[y][x] == " ":
+                    rows[y][x] = "#"
+                    wet += 1
+    land = [(x, y) for y in range(height) for x in range(width) if rows[y][x] == " "]
+    if lighthouses is None:
+        lighthouses = max(3, int(round(density * len(land))))
+    if lighthouses + players > len(land):
+        raise engine.GameError("Not enough land for %d lighthouses and %d players" % (lighthouses, players))
+    cells = rng.sample(land, lighthouses + players)
+    for x, y in cells[:lighthouses]:
+        rows[y][x] = "!"
+    for c, (x, y) in zip(PLAYER_CHARS, cells[lighthouses:]):
+        rows[y][x] = c
+    return "".join("".join(row) + "\n" for row in rows)
+
+def _sign(v):
+    return (v > 0) - (v < 0)
+
+class ScriptedPolicy(object):
+    # Walks to one of the lighthouses nearest to it, attacks it when it has
+    # the energy to take it, tries each possible connection from it once and
+    # picks a new target
+    NEAREST = 4
+
+    def __init__(self, game, num, rng):
+        self.game = game
+        self.player = game.players[num]
+        self.rng = rng
+        self.tried = set()
+        self._retarget()
+
+    def _retarget(self):
+        pos = self.player.pos
+        near = sorted((p for p in self.game.lighthouses if p != pos),
+                      key=lambda p: geom.dist(pos, p))
+        self.target = self.rng.choice(near[:self.NEAREST] or [pos])
+
+    def command(self):
+        game, player = self.game, self.player
+        pos = player.pos
+        if pos in game.lighthouses:
+            lh = game.lighthouses[pos]
+            if lh.owner != player.num and player.energy > lh.energy:
+                return {"command": "attack", "energy": player.energy}
+            if lh.owner == player.num:
+                for dest in sorted(player.keys):
+                    if (dest != pos and game.lighthouses[dest].owner == player.num and
+                        (pos, dest) not in self.tried):
+                        self.tried.add((pos, dest))
+                        return {"command": "connect", "destination": list(dest)}
+            if pos == self.target:
+                self._retarget()
+        dx = _sign(self.target[0] - pos[0])
+        dy = _sign(self.target[1] - pos[1])
+        if not game.island[pos[0] + dx, pos[1] + dy]:
+            dx, dy = self.rng.choice([(x, y) for x in (-1, 0, 1) for y in (-1, 0, 1)
+                                      if game.island[pos[0] + x, pos[1] + y]])
+        return {"command": "move", "x": dx, "y": dy}
+
+def make_trace(cfg, players, rounds, seed=0):
+    # Commands of every player in every round, as played by ScriptedPolicy
+    game = engine.Game(cfg, players)
+    rng = random.Random(seed)
+    policies = [ScriptedPolicy(game, i, rng) for i in range(players)]
+    trace = []
+    for round in range(rounds):
+        game.pre_round()
+        commands = []
+        for policy in policies:
+            move = policy.command()
+            try:
+                game.play(policy.player, move)
+            except engine.MoveError:
+                pass
+            commands.append(move)
+        game.post_round()
+        trace.append(commands)
+    return trace
+
+class _Phase(object):
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.items = 0
+
+    def add(self, seconds, items=0):
+        self.calls += 1
+        self.seconds += seconds
+        self.items += items
+
+    def report(self):
+        r = {"calls": self.calls, "seconds": self.seconds}
+        if self.seconds:
+            r["per_second"] = self.calls / self.seconds
+        if self.calls:
+            r["mean_us"] = self.seconds / self.calls * 1e6
+        if self.items:
+            r["items"] = self.items
+            if self.seconds:
+                r["items_per_second"] = self.items / self.seconds
+        return r
+
+class _StateBuilder(botplayer.BotPlayer):
+    # A BotPlayer without a bot, only used to build turn messages
+    def _spawn(self, cmdline):
+        pass
+
+    def close(self):
+        pass
+
+def _open_view(game):
+    if game.island.w * game.island.h > GAMEVIEW_MAX_CELLS:
+        return None, "map too large"
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+    try:
+        import view
+    except ImportError as e:
+        return None, str(e)
+    return view.GameView(game), None
+
+def _render_samples(game, rng):
+    # Triangles of a lighthouse and two of its nearest neighbours, the
+    # shapes connections actually make
+    positions = sorted(game.lighthouses)
+    tris = []
+    for i in range(RENDER_SAMPLES):
+        a = rng.choice(positions)
+        near = sorted(positions, key=lambda p: geom.dist(a, p))[1:9]
+        if len(near) < 2:
+            break
+        b, c = rng.sample(near, 2)
+        tris.append((a, b, c))
+    return tris
+
+def run(cfg_text, trace, players, gameview=True, seed=0):
+    phases = dict()
+    def phase(name):
+        if name not in phases:
+            phases[name] = _Phase()
+        return phases[name]
+    clock = time.perf_counter
+
+    st = clock()
+    cfg = engine.GameConfig.from_text(cfg_text)
+    game = engine.Game(cfg, players)
+    phase("setup").add(clock() - st)
+
+    full = [_StateBuilder(game, i, None) for i in range(players)]
+    delta = [_StateBuilder(game, i, None) for i in range(players)]
+    for builder in delta:
+        builder.delta = True
+    public = [dict() for i in range(players)]
+    view, skipped = _open_view(game) if gameview else (None, "disabled")
+
+    for round, commands in enumerate(trace):
+        st = clock()
+        game.pre_round()
+        phase("pre_round").add(clock() - st)
+        if round % DECAY_SAMPLE == 0:
+            copy = game.clone()
+            st = clock()
+            for lh in copy.lighthouses.values():
+                lh.decay(10)
+            phase("decay").add(clock() - st, len(copy.lighthouses))
+        for player, move in zip(game.players, commands):
+            num = player.num
+            # The snapshot entries touched since the last turn are rebuilt by
+            # whichever builder asks first, so that is timed on its own
+            st = clock()
+            game.lighthouse_snapshot()
+            phase("snapshot").add(clock() - st)
+            st = clock()
+            data = full[num]._state()
+            phase("state_json").add(clock() - st, len(data))
+            st = clock()
+            data = delta[num]._state()
+            phase("state_delta").add(clock() - st, len(data))
+            st = clock()
+            botplayer.turn_state(game, player, public[num])
+            phase("state_dict").add(clock() - st)
+            st = clock()
+            game.island.get_view(player.pos)
+            phase("view").add(clock() - st)
+            st = clock()
+            try:
+                game.play(player, move)
+            except engine.MoveError:
+                pass
+            phase("play_" + move["command"]).add(clock() - st)
+            if view is not None:
+                st = clock()
+                view.update()
+                phase("gameview").add(clock() - st)
+        st = clock()
+        game.post_round()
+        phase("post_round").add(clock() - st)
+
+    rng = random.Random(seed)
+    for tri in _render_samples(game, rng):
+        st = clock()
+        cells = sum(1 for p in geom.render(tri))
+        phase("render").add(clock() - st, cells)
+        st = clock()
+        origin, mask = geom.render_mask(tri)
+        phase("render_mask").add(clock() - st, int(mask.sum()))
+
+    report = dict((name, p.report()) for name, p in sorted(phases.items()))
+    if view is None:
+        report["gameview"] = {"skipped": skipped}
+    return report, game
+
+def memory(cfg_text, trace, players, games, lazy_energy=False):
+    cfg = engine.GameConfig.from_text(cfg_text)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        # The first game also builds the shared map data
+        engine.Game(cfg, players, lazy_energy=lazy_energy)
+        size = tracemalloc.get_traced_memory()[0] - base
+        st = tracemalloc.get_traced_memory()[0]
+        pool = [engine.Game(cfg, players, lazy_energy=lazy_energy) for i in range(games)]
+        fresh = (tracemalloc.get_traced_memory()[0] - st) / games
+        for game in pool:
+            for commands in trace:
+                game.pre_round()
+                for player, move in zip(game.players, commands):
+                    try:
+                        game.play(player, move)
+                    except engine.MoveError:
+                        pass
+                game.post_round()
+        played = (tracemalloc.get_traced_memory()[0] - st) / games
+    finally:
+        tracemalloc.stop()
+    return {
+        "games": games,
+        "lazy_energy": lazy_energy,
+        "shared_bytes": size - fresh,
+        "fresh_bytes_per_game": fresh,
+        "played_bytes_per_game": played,
+    }, pool[-1]
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the engine hot paths")
+    parser.add_argument("--map", default=None, help="map file (default: generate one)")
+    parser.add_argument("--size", type=int, nargs=2, default=(200, 200), metavar=("W", "H"),
+                        help="generated map size")
+    parser.add_argument("--lighthouses", type=int, default=None,
+                        help="generated lighthouse count (default: from --density)")
+    parser.add_argument("--density", type=float, default=0.0005,
+                        help="generated lighthouses per land cell")
+    parser.add_argument("--water", type=float, default=0.2,
+                        help="fraction of the generated map inside covered by lakes")
+    parser.add_argument("-p", "--players", type=int, default=4, help="players")
+    parser.add_argument("-r", "--rounds", type=int, default=300, help="rounds to replay")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="map and trace seed")
+    parser.add_argument("--no-gameview", action="store_true", help="skip GameView.update")
+    parser.add_argument("--memory", type=int, default=None, metavar="N",
+                        help="measure memory per game over N games instead of timing")
+    parser.add_argument("--lazy-energy", action="store_true",
+                        help="use LazyIsland in --memory mode")
+    parser.add_argument("--save-map", default=None, help="write the map to this file")
+    parser.add_argument("--save-trace", default=None, help="write the action trace (JSON)")
+    parser.add_argument("-o", "--output", default="-", help="JSON report file")
+    args = parser.parse_args(argv)
+
+    if args.map is not None:
+        with open(args.map, "r") as fd:
+            cfg_text = fd.read()
+    else:
+        cfg_text = generate_map(args.size[0], args.size[1], args.lighthouses, args.density,
+                                args.players, args.water, args.seed)
+    if args.save_map is not None:
+        with open(args.save_map, "w") as fd:
+            fd.write(cfg_text)
+    cfg = engine.GameConfig.from_text(cfg_text)
+    if not 1 <= args.players <= len(cfg.players):
+        parser.error("The map has %d player starts" % len(cfg.players))
+
+    st = time.time()
+    trace = make_trace(cfg, args.players, args.rounds, args.seed)
+    trace_time = time.time() - st
+    if args.save_trace is not None:
+        with open(args.save_trace, "w") as fd:
+            json.dump(trace, fd)
+
+    if args.memory is not None:
+        if args.memory < 1:
+            parser.error("--memory needs at least one game")
+        report, game = memory(cfg_text, trace, args.players, args.memory, args.lazy_energy)
+    else:
+        report, game = run(cfg_text, trace, args.players, not args.no_gameview, args.seed)
+    result = {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "map": {
+            "source": args.map,
+            "width": game.island.w,
+            "height": game.island.h,
+            "land": int(game.island.mask.sum()),
+            "lighthouses": len(game.lighthouses),
+        },
+        "players": args.players,
+        "rounds": args.rounds,
+        "seed": args.seed,
+        "trace_time": trace_time,
+        "final": {
+            "scores": [p.score for p in game.players],
+            "owned": sum(lh.owner is not None for lh in game.lighthouses.values()),
+            "connections": len(game.conns),
+            "triangles": len(game.tris),
+        },
+    }
+    result["memory" if args.memory is not None else "phases"] = report
+    if args.output == "-":
+        json.dump(result, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as fd:
+            json.dump(result, fd, indent=1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
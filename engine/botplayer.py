@@ -1,53 +1,301 @@
 #!/usr/bin/python3
 
-import json, subprocess, time, select, sys, os, fcntl
+import json, subprocess, time, select, sys, os, fcntl, socket, importlib.util
 import engine
 
 class CommError(Exception):
     pass
 
+IO_COUNTERS = ("selects", "reads", "writes", "bytes_in", "bytes_out")
+EVENT_COUNTERS = ("soft_timeouts", "hard_timeouts", "move_errors")
+
+def parse_address(spec):
+    # Bot servers are given as "tcp:host:port" or "unix:/path/to/socket";
+    # anything else is a command line
+    if spec.startswith("tcp:"):
+        host, port = spec[4:].rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    elif spec.startswith("unix:"):
+        return socket.AF_UNIX, spec[5:]
+    else:
+        return None
+
+_bot_modules = dict()
+
+def load_bot(spec):
+    # In-process bots are given as "py:path/to/bot.py:BotClass". The bot's
+    # directory goes on sys.path, so it can import interface.py next to it.
+    try:
+        path, name = spec[3:].rsplit(":", 1)
+        path = os.path.abspath(path)
+        if path not in _bot_modules:
+            directory = os.path.dirname(path)
+            if directory not in sys.path:
+                sys.path.insert(0, directory)
+            module_spec = importlib.util.spec_from_file_location(
+                "_bot%d" % len(_bot_modules), path)
+            module = importlib.util.module_from_spec(module_spec)
+            module_spec.loader.exec_module(module)
+            _bot_modules[path] = module
+        return getattr(_bot_modules[path], name)
+    except Exception as e:
+        raise CommError("Cannot load bot %r: %r" % (spec, e))
+
+_CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+def _task_cpu(pid):
+    # Nanosecond run time of every thread from schedstat where the kernel
+    # has it, else utime + stime from stat in clock ticks
+    try:
+        ns = 0
+        for tid in os.listdir("/proc/%d/task" % pid):
+            with open("/proc/%d/task/%s/schedstat" % (pid, tid), "rb") as fd:
+                ns += int(fd.read().split()[0])
+        return ns / 1e9
+    except (OSError, ValueError, IndexError):
+        pass
+    with open("/proc/%d/stat" % pid, "rb") as fd:
+        stat = fd.read()
+    fields = stat[stat.rindex(b")") + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / _CLK_TCK
+
+# Set once the children of a process could not be listed (the kernel may be
+# built without /proc/<pid>/task/<tid>/children), after a warning on stderr
+children_unreadable = False
+
+def cpu_time(pid):
+    # CPU seconds used so far by a process and its live descendants (a bot
+    # started through "sh -c" runs as a child of the shell), or None if the
+    # process is gone. Where children cannot be listed only the process
+    # itself is counted.
+    global children_unreadable
+    total = None
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            used = _task_cpu(pid)
+        except (OSError, ValueError):
+            continue
+        total = used + (total or 0.0)
+        try:
+            with open("/proc/%d/task/%d/children" % (pid, pid), "rb") as fd:
+                pids.extend(int(c) for c in fd.read().split())
+        except (OSError, ValueError):
+            # Gone since its CPU time was read, or its children cannot be
+            # listed
+            if not children_unreadable and os.path.exists("/proc/%d" % pid):
+                children_unreadable = True
+                sys.stderr.write("Cannot list child processes, CPU time of bots "
+                                 "excludes their descendants\n")
+    return total
+
+def wait_exit(proc, timeout):
+    # Exit code of a Popen once it exits, or None after timeout seconds. The
+    # wait is on its pidfd where the system has them, else on waitpid.
+    if proc.poll() is None and hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except OSError:
+            pidfd = None
+        if pidfd is not None:
+            try:
+                select.select([pidfd], [], [], timeout)
+            finally:
+                os.close(pidfd)
+            return proc.poll()
+    try:
+        return proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        return None
+
+def spawns_process(spec):
+    return parse_address(spec) is None and not spec.startswith("py:")
+
+def init_message(game, player):
+    return {
+        "player_num": player.num,
+        "player_count": len(game.players),
+        "position": player.pos,
+        "map": game.island.map,
+        "lighthouses": list(game.lighthouses.keys()),
+    }
+
+def turn_state(game, player, cache):
+    # The turn message as a bot decodes it, built without going through JSON.
+    # cache holds the public part of each lighthouse between turns; bots
+    # must not modify the lists in it.
+    keys = player.keys
+    lighthouses = []
+    for pos, (connections, prefix) in game.lighthouse_snapshot().items():
+        entry = cache.get(pos)
+        if entry is None or entry[0] is not prefix:
+            lh = game.lighthouses[pos]
+            entry = cache[pos] = (prefix, {
+                "position": list(pos),
+                "owner": lh.owner,
+                "energy": lh.energy,
+                "connections": [list(c) for c in connections],
+            })
+        lh = dict(entry[1])
+        lh["have_key"] = pos in keys
+        lighthouses.append(lh)
+    return {
+        "position": list(player.pos),
+        "score": player.score,
+        "energy": player.energy,
+        "view": game.island.get_view(player.pos),
+        "lighthouses": lighthouses,
+    }
+
 class BotPlayer(object):
     INIT_TIMEOUT = 2.0
     MOVE_TIMEOUT = 0.1
     MOVE_HARDTIMEOUT = 0.5
+    READ_SIZE = 65536
+    # With CPU_TIMEOUTS the soft and hard timeouts are judged on the CPU time
+    # the bot process used while the engine waited for it, so a bot is not
+    # failed for waiting on a busy host. No reply may take longer than
+    # WALL_CAP_FACTOR times its hard timeout (MOVE_HARDTIMEOUT for a turn) of
+    # wall time, so a bot that sleeps cannot stall the match for long. Bots
+    # without a local process (SocketBotPlayer) are always judged on wall
+    # time.
+    CPU_TIMEOUTS = False
+    WALL_CAP_FACTOR = 2.0
+    # A closed bot is sent SIGTERM if it has not exited after CLOSE_GRACE
+    # seconds, and SIGKILL after twice that
+    CLOSE_GRACE = 1.0
     def __init__(self, game, playernum, cmdline, debug=False):
         self.alive = True
-        self.p = subprocess.Popen(cmdline, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
-        flag = fcntl.fcntl(self.p.stdout.fileno(), fcntl.F_GETFD)
-        fcntl.fcntl(self.p.stdout.fileno(), fcntl.F_SETFL, flag | os.O_NONBLOCK)
         self.game = game
         self.player = game.players[playernum]
         self.debug = debug
+        self._rbuf = bytearray()
+        self.delta = False
+        self._sent = dict()
+        self.recorder = None
+        self.io = dict.fromkeys(IO_COUNTERS, 0)
+        self._io_done = dict.fromkeys(IO_COUNTERS, 0)
+        self.events = dict.fromkeys(EVENT_COUNTERS, 0)
+        # CPU time of the last reply and of all of them, with CPU_TIMEOUTS
+        self.cpu_used = None
+        self.cpu_total = 0.0
+        # See metrics.py
+        self.metrics = None
+        self._spawn(cmdline)
+
+    def _io_begin(self):
+        # self.io holds the counters for the current init/turn exchange only
+        for k, v in self.io.items():
+            self._io_done[k] += v
+            self.io[k] = 0
+
+    def io_totals(self):
+        return dict((k, self._io_done[k] + self.io[k]) for k in IO_COUNTERS)
+
+    def _spawn(self, cmdline):
+        self.p = subprocess.Popen(cmdline, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
+        flag = fcntl.fcntl(self.p.stdout.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(self.p.stdout.fileno(), fcntl.F_SETFL, flag | os.O_NONBLOCK)
+        self._rfd = self.p.stdout.fileno()
+        self._wfile = self.p.stdin
 
     def _send(self, data):
-        line = json.dumps(data).encode("ascii")
+        self._write(json.dumps(data).encode("ascii"))
+
+    def _write(self, line):
         assert b"\n" not in line
         if self.debug:
             print(">>P%d: %r" % (self.player.num, line))
         try:
-            self.p.stdin.write(line + b"\n")
-            self.p.stdin.flush()
+            self._wfile.write(line + b"\n")
+            self._wfile.flush()
         except:
             raise CommError("Error sending data")
+        self.io["writes"] += 1
+        self.io["bytes_out"] += len(line) + 1
 
-    def _recv(self, soft_timeout, hard_timeout):
-        st = time.time()
-        et = time.time() + soft_timeout
-        ht = time.time() + hard_timeout
-        line = b""
-        try:
-            while not line or line[-1] != 10:
-                to = max(0, ht - time.time())
-                r,w,e = select.select([self.p.stdout],[],[],to)
-                if self.p.stdout not in r:
-                    raise CommError("Bot %r over hard timeout" % self.player.name)
-                c = os.read(self.p.stdout.fileno(), 1)
-                if not c:
-                    raise CommError("Bot closed stdout")
-                line += c
-        except Exception as e:
-            raise CommError("Unknown error: %r" % e)
-        if time.time() > et:
+    def _bot_pid(self):
+        return self.p.pid
+
+    def _cpu_begin(self):
+        # CPU time of the bot when the engine starts waiting for a reply
+        if not self.CPU_TIMEOUTS:
+            return None
+        pid = self._bot_pid()
+        return None if pid is None else (pid, cpu_time(pid))
+
+    def _cpu_deadline(self, st, cpu, timeout):
+        # The new wall deadline for a bot that is over its wall time, or None
+        # if it used up its CPU time or hit the wall cap. A bot cannot use
+        # more CPU time than wall time, so its remaining CPU time is the
+        # least it needs to be waited for.
+        if cpu is None or cpu[1] is None:
+            return None
+        used = cpu_time(cpu[0])
+        now = time.monotonic()
+        cap = st + timeout * max(self.WALL_CAP_FACTOR, 1.0)
+        if used is None or used - cpu[1] >= timeout or now >= cap:
+            return None
+        return min(now + timeout - (used - cpu[1]), cap)
+
+    def _cpu_end(self, cpu, soft_timeout):
+        # Whether the reply came over the soft timeout on CPU time, or None
+        # when judged on wall time
+        if cpu is None or cpu[1] is None:
+            return None
+        used = cpu_time(cpu[0])
+        if used is None:
+            return None
+        self.cpu_used = used - cpu[1]
+        self.cpu_total += self.cpu_used
+        return self.cpu_used > soft_timeout
+
+    # Reading a reply is split so that the same buffering, timeout and
+    # parsing rules serve both this blocking transport and the asyncio one in
+    # multiplex.py: _feed() takes every chunk read from the bot,
+    # _hard_deadline() decides what to do when a wait runs out, and _reply()
+    # decodes the line once it is complete.
+
+    def _line(self, end=None):
+        # The first complete line in the read buffer (ending at end when
+        # known), or None
+        if end is None:
+            end = self._rbuf.find(b"\n")
+            if end < 0:
+                return None
+        line = bytes(self._rbuf[:end+1])
+        del self._rbuf[:end+1]
+        return line
+
+    def _feed(self, chunk):
+        # Buffers one read from the bot; returns the first complete line, or
+        # None if it needs more
+        self.io["reads"] += 1
+        if not chunk:
+            raise CommError("Bot closed stdout")
+        self.io["bytes_in"] += len(chunk)
+        # Only the new chunk can hold the first newline
+        end = chunk.find(b"\n")
+        if end >= 0:
+            end += len(self._rbuf)
+        self._rbuf += chunk
+        return None if end < 0 else self._line(end)
+
+    def _hard_deadline(self, st, cpu, hard_timeout):
+        # The new deadline when a wait for a reply that started at st runs out
+        ht = self._cpu_deadline(st, cpu, hard_timeout)
+        if ht is None:
+            self.events["hard_timeouts"] += 1
+            raise CommError("Bot %r over hard timeout" % self.player.name)
+        return ht
+
+    def _reply(self, line, st, cpu, soft_timeout):
+        # When the reply was complete, for the think/receive split in turn()
+        self._ready = time.monotonic()
+        late = self._cpu_end(cpu, soft_timeout)
+        if late or (late is None and self._ready > st + soft_timeout):
+            self.events["soft_timeouts"] += 1
             sys.stderr.write("Bot %r over soft timeout\n" % self.player.name)
         try:
             if self.debug:
@@ -56,94 +304,235 @@ class BotPlayer(object):
         except Exception as e:
             raise CommError("Invalid JSON: %r" % e)
 
-    def initialize(self):
-        if not self.alive:
-            return
-        self._send({
-            "player_num": self.player.num,
-            "player_count": len(self.game.players),
-            "position": self.player.pos,
-            "map": self.game.island.map,
-            "lighthouses": list(self.game.lighthouses.keys()),
-        })
-        reply = self._recv(self.INIT_TIMEOUT, self.INIT_TIMEOUT)
+    def _recv(self, soft_timeout, hard_timeout):
+        st = time.monotonic()
+        ht = st + hard_timeout
+        cpu = self._cpu_begin()
+        try:
+            fd = self._rfd
+            line = self._line()
+            while line is None:
+                to = max(0, ht - time.monotonic())
+                r,w,e = select.select([fd],[],[],to)
+                self.io["selects"] += 1
+                if fd not in r:
+                    ht = self._hard_deadline(st, cpu, hard_timeout)
+                    continue
+                line = self._feed(os.read(fd, self.READ_SIZE))
+        except Exception as e:
+            raise CommError("Unknown error: %r" % e)
+        return self._reply(line, st, cpu, soft_timeout)
+
+    def _init_message(self):
+        return init_message(self.game, self.player)
+
+    def _greeted(self, reply):
         if not (isinstance(reply, dict) and
                 "name" in reply and
                 isinstance(reply["name"], str)):
             raise CommError("Bot did not greet with name")
         self.player.name = reply["name"]
+        caps = reply.get("capabilities", [])
+        self.delta = isinstance(caps, list) and "delta" in caps
 
-    def turn(self):
+    def start(self):
+        # The bot is started in the constructor; see multiplex.AsyncBotPlayer
+        # for one that is started later
+        pass
+
+    def initialize(self):
         if not self.alive:
             return
+        self._io_begin()
+        self._send(self._init_message())
+        self._greeted(self._recv(self.INIT_TIMEOUT, self.INIT_TIMEOUT))
+
+    def _state(self):
+        # The public part of every lighthouse comes pre-serialized from the
+        # game's snapshot; only have_key and the player fields vary per bot.
+        keys = self.player.keys
         lighthouses = []
-        for lh in self.game.lighthouses.values():
-            connections = [next(l for l in c if l is not lh.pos)
-                            for c in self.game.conns if lh.pos in c]
-            lighthouses.append({
-                "position": lh.pos,
-                "owner": lh.owner,
-                "energy": lh.energy,
-                "connections": connections,
-                "have_key": lh.pos in self.player.keys,
-            })
-        self._send({
-            "position": self.player.pos,
-            "score": self.player.score,
-            "energy": self.player.energy,
-            "view": self.game.island.get_view(self.player.pos),
-            "lighthouses": lighthouses,
-        })
-        move = self._recv(self.MOVE_TIMEOUT, self.MOVE_HARDTIMEOUT)
+        for pos, (connections, prefix) in self.game.lighthouse_snapshot().items():
+            have_key = pos in keys
+            if self.delta:
+                # Only send lighthouses that changed since this bot last saw them
+                seen = (prefix, have_key)
+                if self._sent.get(pos) == seen:
+                    continue
+                self._sent[pos] = seen
+            lighthouses.append(prefix + ("true}" if have_key else "false}"))
+        return ('{"position": %s, "score": %s, "energy": %s, "view": %s, "lighthouses": [%s]}' % (
+            json.dumps(self.player.pos),
+            json.dumps(self.player.score),
+            json.dumps(self.player.energy),
+            json.dumps(self.game.island.get_view(self.player.pos)),
+            ", ".join(lighthouses))).encode("ascii")
+
+    def _play(self, move):
         if not isinstance(move, dict) or "command" not in move:
             raise CommError("Invalid command structure")
         try:
-            if move["command"] == "pass":
-                pass
-            elif move["command"] == "move":
-                if "x" not in move or "y" not in move:
-                    raise engine.MoveError("Move command requires x, y")
-                self.player.move((move["x"], move["y"]))
-            elif move["command"] == "attack":
-                if "energy" not in move or not isinstance(move["energy"], int):
-                    raise engine.MoveError("Attack command requires integer energy")
-                if self.player.pos not in self.game.lighthouses:
-                    raise engine.MoveError("Player must be located at target lighthouse")
-                self.game.lighthouses[self.player.pos].attack(self.player, move["energy"])
-            elif move["command"] == "connect":
-                if "destination" not in move:
-                    raise engine.MoveError("Connect command requires destination")
-                try:
-                    dest = tuple(move["destination"])
-                    hash(dest)
-                except:
-                    raise engine.MoveError("Destination must be a coordinate pair")
-                self.game.connect(self.player, dest)
-            else:
-                raise engine.MoveError("Invalid command %r" % move["command"])
-            self._send({"success": True})
+            self.game.play(self.player, move)
+            return {"success": True}
         except engine.MoveError as e:
             #sys.stderr.write("Bot %r move error: %s\n" % (self.player.name, e.message))
-            self._send({"success": False, "message": str(e)})
+            self.events["move_errors"] += 1
+            return {"success": False, "message": str(e)}
+
+    def turn(self):
+        if not self.alive:
+            return
+        self._io_begin()
+        st = time.monotonic()
+        self._write(self._state())
+        sent = time.monotonic()
+        move = self._recv(self.MOVE_TIMEOUT, self.MOVE_HARDTIMEOUT)
+        self._send(self._finish_turn(move, st, sent))
+
+    def _finish_turn(self, move, st, sent):
+        # Plays the bot's move and reports the turn; returns the result to
+        # send back. st and sent are when the turn started and when its state
+        # was sent.
+        received = time.monotonic()
+        result = self._play(move)
+        if self.metrics is not None:
+            self.metrics.bot_turn(self.player, sent - st, self._ready - sent,
+                                  received - self._ready, time.monotonic() - received,
+                                  self.cpu_used)
+        if self.recorder is not None:
+            self.recorder.turn(self.player.num, move, result)
+        return result
 
     def close(self):
         if self.alive:
-            self.p.stdin.close()
+            try:
+                self.p.stdin.close()
+            except OSError:
+                pass
             self.p.stdout.close()
-            for i in range(100):
-                time.sleep(0.01)
-                if self.p.poll() is not None:
-                    break
-            else:
+            if wait_exit(self.p, self.CLOSE_GRACE) is None:
                 self.p.terminate()
-                for i in range(100):
-                    time.sleep(0.01)
-                    if self.p.poll() is not None:
-                        break
-                else:
+                if wait_exit(self.p, self.CLOSE_GRACE) is None:
                     self.p.kill()
             sys.stderr.write("Bot %r exit code: %r\n" % (self.player.name, self.p.wait()))
             self.alive = False
 
     def __del__(self):
         self.close()
+
+class SocketBotPlayer(BotPlayer):
+    # Talks to a long-lived bot server over TCP or a Unix socket. Every
+    # connection is one match session and carries the same JSON lines as the
+    # stdio protocol, starting with the init message.
+    def _spawn(self, address):
+        self.address = address
+        family, addr = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(self.INIT_TIMEOUT)
+            self.sock.connect(addr)
+            self.sock.settimeout(None)
+        except OSError as e:
+            self.sock.close()
+            self.alive = False
+            raise CommError("Cannot connect to %s: %s" % (address, e))
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._rfd = self.sock.fileno()
+        self._wfile = self.sock.makefile("wb")
+
+    def _bot_pid(self):
+        return None
+
+    def close(self):
+        if self.alive:
+            try:
+                self._wfile.close()
+            except OSError:
+                pass
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            sys.stderr.write("Bot %r session closed\n" % self.player.name)
+            self.alive = False
+
+class InProcessPlayer(BotPlayer):
+    # Runs a Python bot (a subclass of interface.Bot) inside the engine and
+    # calls it directly, with the same messages the stdio protocol carries.
+    # The bot cannot be interrupted, so with cpu_budget set a turn that used
+    # more CPU time than that is failed after the fact, as over the hard
+    # timeout.
+    def __init__(self, game, playernum, bot_class, cpu_budget=None, debug=False):
+        self.cpu_budget = cpu_budget
+        BotPlayer.__init__(self, game, playernum, bot_class, debug=debug)
+
+    def _spawn(self, bot_class):
+        self.bot_class = bot_class
+        self.bot = None
+        self._public = dict()
+
+    def _call(self, budget, method, *args):
+        st = time.thread_time()
+        try:
+            ret = method(*args)
+        except Exception as e:
+            raise CommError("Bot raised %r" % e)
+        if budget is not None and time.thread_time() - st > budget:
+            raise CommError("Bot %r over CPU budget" % self.player.name)
+        return ret
+
+    def initialize(self):
+        if not self.alive:
+            return
+        init = json.loads(json.dumps(self._init_message()))
+        budget = None if self.cpu_budget is None else self.INIT_TIMEOUT
+        self.bot = self._call(budget, self.bot_class, init)
+        self.player.name = self.bot.NAME
+
+    def turn(self):
+        if not self.alive:
+            return
+        st = time.monotonic()
+        state = turn_state(self.game, self.player, self._public)
+        if self.debug:
+            print(">>P%d: %r" % (self.player.num, state))
+        sent = time.monotonic()
+        move = self._call(self.cpu_budget, self.bot.play, state)
+        if self.debug:
+            print("<<P%d: %r" % (self.player.num, move))
+        received = time.monotonic()
+        result = self._play(move)
+        if self.metrics is not None:
+            # Nothing to receive: the bot returns its command
+            self.metrics.bot_turn(self.player, sent - st, received - sent,
+                                  None, time.monotonic() - received)
+        if self.recorder is not None:
+            self.recorder.turn(self.player.num, move, result)
+        if result["success"]:
+            self._call(None, self.bot.success)
+        else:
+            self._call(None, self.bot.error, result["message"], move)
+
+    def close(self):
+        self.alive = False
+
+class DeadPlayer(BotPlayer):
+    # Takes the seat of a bot that could not be started, and never plays
+    def __init__(self, game, playernum):
+        BotPlayer.__init__(self, game, playernum, None)
+
+    def _spawn(self, cmdline):
+        self.alive = False
+
+    def _bot_pid(self):
+        return None
+
+def make_player(game, playernum, spec, debug=False):
+    if parse_address(spec) is not None:
+        return SocketBotPlayer(game, playernum, spec, debug=debug)
+    elif spec.startswith("py:"):
+        return InProcessPlayer(game, playernum, load_bot(spec), debug=debug)
+    else:
+        return BotPlayer(game, playernum, spec, debug=debug)
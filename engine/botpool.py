@@ -0,0 +1,380 @@
+#!/usr/bin/python3
+
+import os, sys, time, shlex, socket, subprocess, selectors, threading, queue, fcntl
+import botplayer
+
+FORKSERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "forkserver.py")
+
+class ForkedProcess(object):
+    # Popen look-alike for a bot forked by a ForkServer. The fork server is
+    # the real parent, so the exit code arrives as a message from it.
+    def __init__(self, pid, stdin_fd, stdout_fd):
+        self.pid = pid
+        self.stdin = os.fdopen(stdin_fd, "wb")
+        self.stdout = os.fdopen(stdout_fd, "rb")
+        self.returncode = None
+        self._exited = threading.Event()
+
+    def _set_exit(self, code):
+        self.returncode = code
+        self._exited.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self._exited.wait(timeout)
+        return self.returncode
+
+    def _signal(self, sig):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self._signal(15)
+
+    def kill(self):
+        self._signal(9)
+
+class ForkServer(object):
+    # Scripts must keep their entry point under `if __name__ == "__main__"`;
+    # a script that fails to load is reported here and run with plain Popen.
+    # The server answers spawn requests in order, so requests and pid replies
+    # are numbered as they go; a reply that arrives after its spawn() gave up
+    # is skipped by the next one.
+    LOAD_TIMEOUT = 10.0
+
+    def __init__(self, cmdline):
+        argv = shlex.split(cmdline)
+        self.sock, child = socket.socketpair()
+        self.proc = subprocess.Popen(
+            [argv[0], FORKSERVER, str(child.fileno())] + argv[1:],
+            pass_fds=(child.fileno(),), stdin=subprocess.DEVNULL)
+        child.close()
+        self.lock = threading.Lock()
+        # (reply number, pid); requests are counted under lock, replies in
+        # the watcher thread
+        self.pids = queue.Queue()
+        self._requests = 0
+        self._replies = 0
+        # Children by pid, exit codes that arrived before spawn() registered
+        # their child, children of abandoned requests, and whether the server
+        # is gone; shared with the watcher thread under _children_lock
+        self.children = dict()
+        self._exits = dict()
+        self._orphans = set()
+        self._dead = False
+        self._children_lock = threading.Lock()
+        self._buf = b""
+        self.sock.settimeout(self.LOAD_TIMEOUT)
+        try:
+            ready = self.sock.recv(6)
+        except OSError:
+            ready = b""
+        self.sock.settimeout(None)
+        if ready != b"ready\n":
+            self.sock.close()
+            self.proc.kill()
+            self.proc.wait()
+            raise botplayer.CommError("Fork server could not load %r" % cmdline)
+
+    @staticmethod
+    def supports(cmdline):
+        try:
+            argv = shlex.split(cmdline)
+        except ValueError:
+            return False
+        return (len(argv) >= 2 and os.path.basename(argv[0]).startswith("python3")
+                and argv[1].endswith(".py"))
+
+    def spawn(self, timeout):
+        r0, w0 = os.pipe()
+        r1, w1 = os.pipe()
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            try:
+                socket.send_fds(self.sock, [b"S"], [r0, w1])
+            finally:
+                os.close(r0)
+                os.close(w1)
+            self._requests += 1
+            while True:
+                try:
+                    num, pid = self.pids.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    os.close(w0)
+                    os.close(r1)
+                    raise botplayer.CommError("Fork server did not answer")
+                if num == self._requests:
+                    break
+                self._orphan(pid)
+        proc = ForkedProcess(pid, w0, r1)
+        with self._children_lock:
+            code = self._exits.pop(pid, None)
+            if code is None and self._dead:
+                code = -1
+            if code is None:
+                self.children[pid] = proc
+        if code is not None:
+            proc._set_exit(code)
+        return proc
+
+    def _orphan(self, pid):
+        # The child of a request whose spawn() timed out. Its pipes are
+        # closed, so it exits on its own; only its exit code is dropped.
+        with self._children_lock:
+            if self._exits.pop(pid, None) is None:
+                self._orphans.add(pid)
+
+    def _readable(self):
+        # Called from the watcher thread only
+        try:
+            data = self.sock.recv(4096)
+        except OSError:
+            data = b""
+        if not data:
+            # The fork server is gone, and with it the exit codes of its
+            # children
+            with self._children_lock:
+                self._dead = True
+                children, self.children = self.children, dict()
+            for proc in children.values():
+                proc._set_exit(-1)
+            return False
+        self._buf += data
+        while b"\n" in self._buf:
+            line, self._buf = self._buf.split(b"\n", 1)
+            words = line.split()
+            if words[0] == b"pid":
+                self._replies += 1
+                self.pids.put((self._replies, int(words[1])))
+            elif words[0] == b"exit":
+                pid, code = int(words[1]), int(words[2])
+                with self._children_lock:
+                    proc = self.children.pop(pid, None)
+                    if pid in self._orphans:
+                        self._orphans.discard(pid)
+                    elif proc is None:
+                        self._exits[pid] = code
+                if proc is not None:
+                    proc._set_exit(code)
+        return True
+
+    def close(self):
+        self.sock.close()
+        self.proc.wait()
+
+class ChildWatcher(threading.Thread):
+    # Reaps released bot processes from a single thread, waking up on pidfds
+    # and fork server messages instead of polling. Bots that do not exit after
+    # their stdin closes are sent SIGTERM after GRACE seconds and SIGKILL after
+    # twice that.
+    GRACE = 1.0
+    POLL = 0.01
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="ChildWatcher", daemon=True)
+        self.sel = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending = dict()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_w, False)
+        self.sel.register(self._wake_r, selectors.EVENT_READ)
+        self.start()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"x")
+        except BlockingIOError:
+            pass
+
+    def add_server(self, server):
+        with self.lock:
+            self.sel.register(server.sock, selectors.EVENT_READ, server)
+        self._wake()
+
+    def watch(self, proc, record):
+        record["released"] = time.monotonic()
+        record["done"] = threading.Event()
+        pidfd = None
+        if isinstance(proc, subprocess.Popen) and hasattr(os, "pidfd_open"):
+            try:
+                pidfd = os.pidfd_open(proc.pid)
+            except OSError:
+                pass
+        with self.lock:
+            self.pending[proc] = [record, pidfd, 0]
+            if pidfd is not None:
+                self.sel.register(pidfd, selectors.EVENT_READ, proc)
+        self._wake()
+
+    def _finish(self, proc):
+        record, pidfd, stage = self.pending.pop(proc)
+        if pidfd is not None:
+            self.sel.unregister(pidfd)
+            os.close(pidfd)
+        record["exit"] = proc.poll()
+        record["teardown"] = time.monotonic() - record["released"]
+        sys.stderr.write("Bot %r exit code: %r\n" % (record["name"], record["exit"]))
+        record["done"].set()
+
+    def run(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                timeout = None
+                for proc, entry in list(self.pending.items()):
+                    record, pidfd, stage = entry
+                    if proc.poll() is not None:
+                        self._finish(proc)
+                        continue
+                    # stage 0: waiting for a clean exit, 1: terminated, 2: killed
+                    if stage < 2 and now >= record["released"] + self.GRACE * (stage + 1):
+                        if stage == 0:
+                            proc.terminate()
+                        else:
+                            proc.kill()
+                        entry[2] = stage = stage + 1
+                    waits = []
+                    if stage < 2:
+                        waits.append(record["released"] + self.GRACE * (stage + 1) - now)
+                    if pidfd is None and isinstance(proc, subprocess.Popen):
+                        waits.append(self.POLL)
+                    if waits:
+                        wait = max(0, min(waits))
+                        timeout = wait if timeout is None else min(timeout, wait)
+            for key, events in self.sel.select(timeout):
+                if key.fileobj == self._wake_r:
+                    os.read(self._wake_r, 512)
+                elif isinstance(key.data, ForkServer):
+                    if not key.data._readable():
+                        with self.lock:
+                            self.sel.unregister(key.fileobj)
+
+class BotPool(object):
+    # Keeps `size` idle bot processes per command line, spawned ahead of time,
+    # and hands them to matches on demand. Python 3 bots ("python3 bot.py
+    # ...") are forked from a fork server that has already loaded the script
+    # when fork_server is set. Released bots are reaped concurrently by a
+    # ChildWatcher, so closing a match never blocks on its bots.
+    # Longest wait() for a released bot: it is killed after 2 * GRACE
+    WAIT_TIMEOUT = 3 * ChildWatcher.GRACE + 1.0
+
+    def __init__(self, size=1, fork_server=False):
+        self.size = size
+        self.fork_server = fork_server
+        self.idle = dict()
+        self.servers = dict()
+        self.records = []
+        self.lock = threading.Lock()
+        self.watcher = ChildWatcher()
+        self._refill = queue.Queue()
+        self._spawner = threading.Thread(target=self._spawn_loop, name="BotPool", daemon=True)
+        self._spawner.start()
+
+    def _create(self, cmdline):
+        st = time.monotonic()
+        server = None
+        if self.fork_server and ForkServer.supports(cmdline):
+            with self.lock:
+                if cmdline not in self.servers:
+                    try:
+                        self.servers[cmdline] = ForkServer(cmdline)
+                        self.watcher.add_server(self.servers[cmdline])
+                    except botplayer.CommError as e:
+                        sys.stderr.write("%s, not forking it\n" % e)
+                        self.servers[cmdline] = None
+                server = self.servers[cmdline]
+        if server is not None:
+            proc = server.spawn(botplayer.BotPlayer.INIT_TIMEOUT)
+        else:
+            proc = subprocess.Popen(cmdline, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True)
+        return proc, time.monotonic() - st
+
+    def _spawn_loop(self):
+        while True:
+            cmdline = self._refill.get()
+            try:
+                entry = self._create(cmdline)
+            except Exception as e:
+                sys.stderr.write("Bot pool could not spawn %r: %r\n" % (cmdline, e))
+                continue
+            with self.lock:
+                self.idle.setdefault(cmdline, []).append(entry)
+
+    def prewarm(self, cmdline):
+        for i in range(self.size):
+            self._refill.put(cmdline)
+
+    def acquire(self, cmdline):
+        st = time.monotonic()
+        entry = None
+        with self.lock:
+            if cmdline not in self.idle:
+                self.idle[cmdline] = []
+                first = True
+            else:
+                first = False
+            idle = self.idle[cmdline]
+            while idle and entry is None:
+                entry = idle.pop(0)
+                if entry[0].poll() is not None:
+                    entry = None
+        if first:
+            self.prewarm(cmdline)
+        else:
+            self._refill.put(cmdline)
+        warm = entry is not None
+        if entry is None:
+            entry = self._create(cmdline)
+        proc, spawn = entry
+        record = {
+            "cmdline": cmdline,
+            "name": None,
+            "warm": warm,
+            "spawn": spawn,
+            "acquire": time.monotonic() - st,
+        }
+        return proc, record
+
+    def release(self, proc, record):
+        for f in (proc.stdin, proc.stdout):
+            try:
+                f.close()
+            except OSError:
+                pass
+        self.records.append(record)
+        self.watcher.watch(proc, record)
+
+    def wait(self, records, timeout=WAIT_TIMEOUT):
+        # For all the records, at most `timeout` seconds in total
+        deadline = time.monotonic() + timeout
+        for record in records:
+            if "done" in record:
+                record["done"].wait(max(0, deadline - time.monotonic()))
+
+class PooledBotPlayer(botplayer.BotPlayer):
+    def __init__(self, game, playernum, cmdline, pool, debug=False):
+        self.pool = pool
+        botplayer.BotPlayer.__init__(self, game, playernum, cmdline, debug=debug)
+
+    def _spawn(self, cmdline):
+        self.p, self.record = self.pool.acquire(cmdline)
+        fd = self.p.stdout.fileno()
+        flag = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flag | os.O_NONBLOCK)
+        self._rfd = fd
+        self._wfile = self.p.stdin
+
+    def close(self):
+        if self.alive:
+            self.alive = False
+            self.record["name"] = self.player.name
+            self.pool.release(self.p, self.record)
+
+    def lifecycle(self):
+        return dict((k, self.record.get(k))
+                    for k in ("warm", "spawn", "acquire", "teardown", "exit"))
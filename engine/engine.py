@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
-import geom, math
+import geom, math, json, io, copy
+import numpy as np
 
 class MoveError(Exception):
     pass
@@ -8,37 +9,117 @@ class MoveError(Exception):
 class GameError(Exception):
     pass
 
+# Everything about a map that games only read: the map itself, land mask,
+# horizon, lighthouse positions and index, player starts, and the regen field
+# and blocked lighthouse pairs (filled in by Game). One MapData is built per
+# GameConfig and shared by every game, clone and island on it.
+class MapData(object):
+    __slots__ = ("map", "w", "h", "mask", "horizon", "lighthouses", "lh_index",
+                 "players", "regen", "blocked", "_padded_fields", "_support")
+
+    def __init__(self, island_map, lighthouses=(), players=(), tables=None):
+        self.map = island_map
+        self.h = len(island_map)
+        self.w = len(island_map[0])
+        self.lighthouses = list(lighthouses)
+        self.lh_index = dict((x, i) for i, x in enumerate(self.lighthouses))
+        self.players = list(players)
+        if tables is not None:
+            # Read-only, shared with every process on the map (see mapcache.py)
+            self.mask = tables["mask"]
+            self.horizon = tables["horizon"]
+            self.regen = tables["regen"]
+            self.blocked = tables["blocked"]
+        else:
+            self.mask = np.array(island_map, dtype=bool)
+            self.horizon = Island.horizon_mask()
+            self.regen = None
+            self.blocked = None
+        self._padded_fields = dict()
+        self._support = None
+
+    def padded(self, field):
+        # field (None for all zeros) in the middle of a zero array shaped like
+        # Island._padded. The ones for no field and for the regen field are
+        # built once; callers must not write to them.
+        if field is None or field is self.regen:
+            cached = self._padded_fields.get(field is None)
+            if cached is not None:
+                return cached
+        dist = Island.HORIZON
+        padded = np.zeros((self.h + 2 * dist, self.w + 2 * dist), dtype=Island.DTYPE)
+        if field is not None:
+            padded[dist:-dist, dist:-dist] = field
+        if field is None or field is self.regen:
+            self._padded_fields[field is None] = padded
+        return padded
+
+    def support(self, field):
+        # Flat indices into Island._padded of the cells where field is not
+        # zero. Built once for the regen field.
+        if field is self.regen and self._support is not None:
+            return self._support
+        cells = np.flatnonzero(self.padded(field))
+        if field is self.regen:
+            self._support = cells
+        return cells
+
+# island.energy[x, y]: one cell of energy, 0 and not writable off land
+class _EnergyProxy(object):
+    __slots__ = ("island",)
+
+    def __init__(self, island):
+        self.island = island
+
+    def __getitem__(self, pos):
+        island = self.island
+        if island[pos]:
+            return island._get_energy(*pos)
+        else:
+            return 0
+
+    def __setitem__(self, pos, val):
+        island = self.island
+        if val > island.MAX_ENERGY:
+            val = island.MAX_ENERGY
+        assert val >= 0
+        if island[pos]:
+            island._set_energy(pos[0], pos[1], val)
+
 class Island(object):
     MAX_ENERGY = 100
     HORIZON = 3
-    def __init__(self, island_map):
-        self._island = island_map
-        self.h = len(self._island)
-        self.w = len(self._island[0])
-        self._energymap = [[0] * self.w for i in range(self.h)]
-        self._horizonmap = []
+    # Energy never exceeds MAX_ENERGY
+    DTYPE = np.int16
+    __slots__ = ("_data", "_island", "h", "w", "_mask", "_horizonmap",
+                 "_padded", "_energymap", "_energy")
+
+    def __init__(self, data):
+        if not isinstance(data, MapData):
+            data = MapData(data)
+        self._data = data
+        self._island = data.map
+        self.h = data.h
+        self.w = data.w
+        self._mask = data.mask
+        self._horizonmap = data.horizon
         dist = self.HORIZON
+        # Energy lives in the middle of a zero-padded array, so that views near
+        # the map edges are plain slices
+        self._padded = np.zeros((self.h + 2 * dist, self.w + 2 * dist), dtype=self.DTYPE)
+        self._energymap = self._padded[dist:-dist, dist:-dist]
+        self._energy = _EnergyProxy(self)
+
+    @classmethod
+    def horizon_mask(cls):
+        dist = cls.HORIZON
+        horizon = []
         for y in range(-dist, dist + 1):
             row = []
             for x in range(-dist, dist + 1):
-                row.append(geom.dist((0,0), (x,y)) <= self.HORIZON)
-            self._horizonmap.append(row)
-
-        class _Energy(object):
-            def __getitem__(unused, pos):
-                x, y = pos
-                if self[pos]:
-                    return self._energymap[y][x]
-                else:
-                    return 0
-            def __setitem__(unused, pos, val):
-                x, y = pos
-                if val > self.MAX_ENERGY:
-                    val = self.MAX_ENERGY
-                assert val >= 0
-                if self[pos]:
-                    self._energymap[y][x] = val
-        self._energy = _Energy()
+                row.append(geom.dist((0,0), (x,y)) <= dist)
+            horizon.append(row)
+        return np.array(horizon, dtype=bool)
 
     def __getitem__(self, pos):
         x, y = pos
@@ -47,35 +128,163 @@ class Island(object):
         else:
             return False
 
+    def _get_energy(self, x, y):
+        return int(self._energymap[y, x])
+
+    def _set_energy(self, x, y, val):
+        self._energymap[y, x] = val
+
     @property
     def energy(self):
         return self._energy
 
+    @property
+    def mask(self):
+        return self._mask
+
+    def energy_array(self):
+        return self._energymap
+
+    def load_energy(self, energy):
+        self._energymap[...] = energy
+
+    def clone(self):
+        # The map, mask and horizon are shared; only the energy is copied
+        island = copy.copy(self)
+        dist = self.HORIZON
+        island._padded = self._padded.copy()
+        island._energymap = island._padded[dist:-dist, dist:-dist]
+        island._energy = _EnergyProxy(island)
+        return island
+
+    def save_regen(self, field, cells):
+        # What regen(field) and then writes to cells change, for
+        # restore_regen to put back: the cells where field is not zero, and
+        # the written ones
+        support = self._data.support(field)
+        return (support, self._padded.reshape(-1)[support],
+                [(pos, self._get_energy(*pos)) for pos in cells])
+
+    def restore_regen(self, saved):
+        support, values, cells = saved
+        self._padded.reshape(-1)[support] = values
+        for (x, y), val in cells:
+            self._set_energy(x, y, val)
+
+    def regen(self, field):
+        # Energy never exceeds MAX_ENERGY, so only cells where field is not
+        # zero change
+        support = self._data.support(field)
+        energy = self._padded.reshape(-1)
+        increments = self._data.padded(field).reshape(-1)[support]
+        energy[support] = np.minimum(energy[support] + increments, self.MAX_ENERGY)
+
     def get_view(self, pos):
         px, py = pos
         dist = self.HORIZON
-        view = []
-        for y in range(-dist, dist + 1):
-            row = []
-            for x in range(-dist, dist + 1):
-                if self._horizonmap[y+dist][x+dist]:
-                    row.append(self.energy[px+x, py+y])
-                else:
-                    row.append(-1)
-            view.append(row)
-        return view
+        view = self._padded[py:py + 2 * dist + 1, px:px + 2 * dist + 1]
+        return np.where(self._horizonmap, view, -1).tolist()
 
     @property
     def map(self):
         return self._island
 
+# Energy only ever grows by the regen field each round and is clamped at
+# MAX_ENERGY, so instead of updating every cell each round this backend stores
+# the value each cell had when last written plus that round number, and works
+# out the current value when it is read.
+class LazyIsland(Island):
+    __slots__ = ("_round", "_stamps", "_field", "_field_src")
+
+    def __init__(self, data):
+        Island.__init__(self, data)
+        data = self._data
+        self._round = 0
+        self._stamps = np.zeros(self._padded.shape, dtype=np.int32)
+        self._field = data.padded(None)
+        self._field_src = None
+
+    def _evaluate(self, value, field, stamp):
+        return np.minimum(value + field * (self._round - stamp), self.MAX_ENERGY)
+
+    def _get_energy(self, x, y):
+        dist = self.HORIZON
+        x, y = x + dist, y + dist
+        return int(self._evaluate(self._padded[y, x], self._field[y, x],
+                                  self._stamps[y, x]))
+
+    def _set_energy(self, x, y, val):
+        dist = self.HORIZON
+        self._padded[y + dist, x + dist] = val
+        self._stamps[y + dist, x + dist] = self._round
+
+    def energy_array(self):
+        dist = self.HORIZON
+        window = np.s_[dist:-dist, dist:-dist]
+        return self._evaluate(self._padded[window], self._field[window],
+                              self._stamps[window])
+
+    def load_energy(self, energy):
+        dist = self.HORIZON
+        self._padded[dist:-dist, dist:-dist] = energy
+        self._stamps[...] = self._round
+
+    def clone(self):
+        # _field is replaced rather than written to, so clones can share it
+        island = Island.clone(self)
+        island._stamps = self._stamps.copy()
+        return island
+
+    def save_regen(self, field, cells):
+        # Regen only advances the round, unless the field changes and every
+        # cell is brought up to date
+        dist = self.HORIZON
+        grid = None
+        if field is not self._field_src:
+            grid = (self._padded.copy(), self._stamps.copy())
+        return (self._round, self._field, self._field_src, grid,
+                [(x + dist, y + dist, self._padded[y + dist, x + dist],
+                  self._stamps[y + dist, x + dist]) for x, y in cells])
+
+    def restore_regen(self, saved):
+        self._round, self._field, self._field_src, grid, cells = saved
+        if grid is not None:
+            self._padded[...], self._stamps[...] = grid
+        for x, y, val, stamp in cells:
+            self._padded[y, x] = val
+            self._stamps[y, x] = stamp
+
+    def regen(self, field):
+        if field is not self._field_src:
+            self._padded[...] = self._evaluate(self._padded, self._field, self._stamps)
+            self._stamps[...] = self._round
+            self._field = self._data.padded(field)
+            self._field_src = field
+        self._round += 1
+
+    def get_view(self, pos):
+        px, py = pos
+        dist = self.HORIZON
+        window = np.s_[py:py + 2 * dist + 1, px:px + 2 * dist + 1]
+        view = self._evaluate(self._padded[window], self._field[window],
+                              self._stamps[window])
+        return np.where(self._horizonmap, view, -1).tolist()
+
 class Lighthouse(object):
+    __slots__ = ("game", "pos", "owner", "energy")
+
     def __init__(self, game, pos):
         self.game = game
         self.pos = pos
         self.owner = None
         self.energy = 0
 
+    def clone(self, game):
+        lh = Lighthouse(game, self.pos)
+        lh.owner = self.owner
+        lh.energy = self.energy
+        return lh
+
     def attack(self, player, strength):
         if not isinstance(strength, int):
             raise MoveError("Strength must be an int")
@@ -89,18 +298,31 @@ class Lighthouse(object):
             self.decay(d)
             strength -= d
         if strength:
-            self.owner = player.num
+            self._set_owner(player.num)
             self.energy += strength
+            self.game._touch(self.pos)
 
     def decay(self, by):
+        if self.owner is None:
+            return
         self.energy -= by
+        self.game._touch(self.pos)
         if self.energy <= 0:
             self.energy = 0
-            self.owner = None
-            self.game.conns = set(i for i in self.game.conns if self.pos not in i)
-            self.game.tris = dict(i for i in self.game.tris.items() if self.pos not in i[0])
+            # Connections and triangles go first, while they still have an
+            # owner
+            self.game._unlink(self.pos)
+            self._set_owner(None)
+
+    def _set_owner(self, owner):
+        old = self.owner
+        if owner != old:
+            self.owner = owner
+            self.game._owner_changed(self.pos, old, owner)
 
 class Player(object):
+    __slots__ = ("num", "game", "pos", "score", "energy", "keys", "name")
+
     def __init__(self, game, num, init_pos):
         self.num = num
         self.game = game
@@ -110,6 +332,14 @@ class Player(object):
         self.keys = set()
         self.name = "Player %d" % num
 
+    def clone(self, game):
+        player = Player(game, self.num, self.pos)
+        player.score = self.score
+        player.energy = self.energy
+        player.keys = set(self.keys)
+        player.name = self.name
+        return player
+
     def move(self, delta):
         dx, dy = delta
         if dx not in (0, 1, -1) or dy not in (0, 1, -1):
@@ -120,9 +350,23 @@ class Player(object):
         self.pos = new_pos
 
 class GameConfig(object):
+    # MapData shared by the games on this config, built by the first one
+    data = None
+
     def __init__(self, mapfile):
         with open(mapfile, "r") as fd:
-            lines = [l.replace("\n", "") for l in fd.readlines()]
+            self._parse(fd.readlines())
+
+    @classmethod
+    def from_text(cls, text):
+        cfg = cls.__new__(cls)
+        cfg._parse(io.StringIO(text).readlines())
+        return cfg
+
+    def _parse(self, lines):
+        # Tables derived from the map, set when loaded through mapcache
+        self.tables = None
+        lines = [l.replace("\n", "") for l in lines]
         self.lighthouses = []
         players = []
         self.island = []
@@ -150,17 +394,94 @@ class GameConfig(object):
             not all(not (i[0] or i[-1]) for i in self.island)):
             raise GameError("Map border must not be part of island")
 
+# Game events, passed to the listeners added with Game.subscribe as tuples:
+#
+#   (OWNER, pos, old, new)             lighthouse owner changed (None: no owner)
+#   (CONNECT, pair, owner)             connection added
+#   (DISCONNECT, pair, owner)          connection removed
+#   (TRIANGLE_ADD, tri, owner, cells)  triangle formed, cells is a CellMask
+#   (TRIANGLE_DROP, tri, owner, cells) triangle destroyed
+#
+# They come from attack, decay and connect, and from undo() reverting them, so
+# a listener always sees the same state the game has. Game.rates, the points
+# each player gets in post_round, is kept up to date from them.
+OWNER = "owner"
+CONNECT = "connect"
+DISCONNECT = "disconnect"
+TRIANGLE_ADD = "triangle_add"
+TRIANGLE_DROP = "triangle_drop"
+
+def _remove(index, key, item):
+    items = index[key]
+    items.remove(item)
+    if not items:
+        del index[key]
+
 class Game(object):
     RDIST = 5
-    def __init__(self, cfg, numplayers=None):
+    def __init__(self, cfg, numplayers=None, lazy_energy=False):
         if numplayers is None:
             numplayers = len(cfg.players)
         assert numplayers <= len(cfg.players)
-        self.island = Island(cfg.island)
-        self.lighthouses = dict((x, Lighthouse(self, x)) for x in cfg.lighthouses)
+        data = cfg.data
+        if data is None:
+            data = cfg.data = MapData(cfg.island, cfg.lighthouses, cfg.players, cfg.tables)
+        self.data = data
+        if lazy_energy:
+            self.island = LazyIsland(data)
+        else:
+            self.island = Island(data)
+        self.lighthouses = dict((x, Lighthouse(self, x)) for x in data.lighthouses)
         self.conns = set()
         self.tris = dict()
-        self.players = [Player(self, i, pos) for i, pos in enumerate(cfg.players[:numplayers])]
+        # Connections and triangles by lighthouse, only for lighthouses that
+        # have any
+        self._conn_index = dict()
+        self._tri_index = dict()
+        self._conn_grid = geom.SegmentGrid()
+        self._lh_index = data.lh_index
+        if data.blocked is None:
+            data.blocked = self._blocked_pairs()
+        self.blocked = data.blocked
+        self._snapshot = dict.fromkeys(data.lighthouses)
+        self._dirty = set(data.lighthouses)
+        self.players = [Player(self, i, pos) for i, pos in enumerate(data.players[:numplayers])]
+        if data.regen is None:
+            data.regen = self._regen_field()
+        self.regen = data.regen
+        self.rates = [0] * len(self.players)
+        self._listeners = []
+        self._journal = None
+
+    def _blocked_pairs(self):
+        # blocked[i, j] is set when another lighthouse lies on the segment
+        # between lighthouses i and j. The only lattice points on that segment
+        # are the multiples of its gcd-reduced step.
+        index = self._lh_index
+        blocked = np.zeros((len(index), len(index)), dtype=bool)
+        for a, i in index.items():
+            for b, j in index.items():
+                if j <= i:
+                    continue
+                dx, dy = b[0] - a[0], b[1] - a[1]
+                g = math.gcd(dx, dy)
+                sx, sy = dx // g, dy // g
+                for k in range(1, g):
+                    if (a[0] + sx * k, a[1] + sy * k) in index:
+                        blocked[i, j] = blocked[j, i] = True
+                        break
+        return blocked
+
+    def _regen_field(self):
+        field = np.zeros((self.island.h, self.island.w), dtype=Island.DTYPE)
+        for pos in self.lighthouses:
+            for y in range(pos[1]-self.RDIST+1, pos[1]+self.RDIST):
+                for x in range(pos[0]-self.RDIST+1, pos[0]+self.RDIST):
+                    dist = geom.dist(pos, (x,y))
+                    delta = int(math.floor(self.RDIST - dist))
+                    if delta > 0 and self.island[x,y]:
+                        field[y, x] += delta
+        return field
 
     def connect(self, player, dest_pos):
         if player.pos not in self.lighthouses:
@@ -179,35 +500,155 @@ class Game(object):
         pair = frozenset((orig.pos, dest.pos))
         if pair in self.conns:
             raise MoveError("Connection already exists")
-        x0, x1 = sorted((orig.pos[0], dest.pos[0]))
-        y0, y1 = sorted((orig.pos[1], dest.pos[1]))
-        for lh in self.lighthouses:
-            if (x0 <= lh[0] <= x1 and y0 <= lh[1] <= y1 and
-                lh not in (orig.pos, dest.pos) and
-                geom.colinear(orig.pos, dest.pos, lh)):
-                raise MoveError("Connection cannot intersect a lighthouse")
-        new_tris = set()
-        for c in self.conns:
+        if self.blocked[self._lh_index[orig.pos], self._lh_index[dest.pos]]:
+            raise MoveError("Connection cannot intersect a lighthouse")
+        for c in self._conn_grid.candidates(orig.pos, dest.pos):
             if geom.intersect(tuple(c), (orig.pos, dest.pos)):
                 raise MoveError("Connection cannot intersect another connection")
-            if orig.pos in c:
-                third = next(l for l in c if l != orig.pos)
-                if frozenset((third, dest.pos)) in self.conns:
-                    new_tris.add((orig.pos, dest.pos, third))
+        new_tris = set()
+        for c in self._conn_index.get(orig.pos, ()):
+            third = next(l for l in c if l != orig.pos)
+            if frozenset((third, dest.pos)) in self._conn_index.get(dest.pos, ()):
+                new_tris.add((orig.pos, dest.pos, third))
 
         player.keys.remove(dest.pos)
-        self.conns.add(pair)
+        self._link(pair)
         for i in new_tris:
-            self.tris[i] = [j for j in geom.render(i) if self.island[j]]
+            self._add_tri(i, self._tri_cells(i))
+
+    def _tri_cells(self, tri):
+        (x0, y0), mask = geom.render_mask(tri)
+        h, w = mask.shape
+        mask &= self.island.mask[y0:y0+h, x0:x0+w]
+        return geom.CellMask((x0, y0), mask)
+
+    def play(self, player, move):
+        # Applies one turn command, as sent by a bot
+        if move["command"] == "pass":
+            pass
+        elif move["command"] == "move":
+            if "x" not in move or "y" not in move:
+                raise MoveError("Move command requires x, y")
+            player.move((move["x"], move["y"]))
+        elif move["command"] == "attack":
+            if "energy" not in move or not isinstance(move["energy"], int):
+                raise MoveError("Attack command requires integer energy")
+            if player.pos not in self.lighthouses:
+                raise MoveError("Player must be located at target lighthouse")
+            self.lighthouses[player.pos].attack(player, move["energy"])
+        elif move["command"] == "connect":
+            if "destination" not in move:
+                raise MoveError("Connect command requires destination")
+            try:
+                dest = tuple(move["destination"])
+                hash(dest)
+            except:
+                raise MoveError("Destination must be a coordinate pair")
+            self.connect(player, dest)
+        else:
+            raise MoveError("Invalid command %r" % move["command"])
+
+    def _touch(self, pos):
+        self._dirty.add(pos)
+
+    def subscribe(self, listener):
+        # listener(event) is called after every change, see OWNER
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self._listeners.remove(listener)
+
+    def _emit(self, event):
+        for listener in self._listeners:
+            listener(event)
+
+    def _owner_changed(self, pos, old, new):
+        if old is not None:
+            self.rates[old] -= 2
+        if new is not None:
+            self.rates[new] += 2
+        if self._listeners:
+            self._emit((OWNER, pos, old, new))
+
+    def lighthouse_snapshot(self):
+        # Public lighthouse state, identical for every player: for each
+        # lighthouse, its connections and its turn message JSON up to the
+        # per-player "have_key" value. Entries are rebuilt only after the
+        # lighthouse was touched by attack, decay, connect or disconnect.
+        for pos in self._dirty:
+            lh = self.lighthouses[pos]
+            connections = [next(l for l in c if l != pos) for c in self._conn_index.get(pos, ())]
+            prefix = json.dumps({
+                "position": pos,
+                "owner": lh.owner,
+                "energy": lh.energy,
+                "connections": connections,
+            })[:-1] + ', "have_key": '
+            self._snapshot[pos] = (connections, prefix)
+        self._dirty.clear()
+        return self._snapshot
+
+    # Every change to connections and triangles goes through _link, _cut,
+    # _add_tri and _drop_tri, which log their inverse while a delta is being
+    # recorded (see apply).
+    def _link(self, pair):
+        # Both ends of a connection and all corners of a triangle have the
+        # same owner
+        owner = self.lighthouses[next(iter(pair))].owner
+        self.conns.add(pair)
+        self._conn_grid.add(pair, *pair)
+        for pos in pair:
+            self._conn_index.setdefault(pos, set()).add(pair)
+            self._touch(pos)
+        self.rates[owner] += 2
+        if self._listeners:
+            self._emit((CONNECT, pair, owner))
+        if self._journal is not None:
+            self._journal.append((self._cut, pair))
+
+    def _cut(self, pair):
+        owner = self.lighthouses[next(iter(pair))].owner
+        self.conns.remove(pair)
+        self._conn_grid.remove(pair)
+        for pos in pair:
+            _remove(self._conn_index, pos, pair)
+            self._touch(pos)
+        self.rates[owner] -= 2
+        if self._listeners:
+            self._emit((DISCONNECT, pair, owner))
+        if self._journal is not None:
+            self._journal.append((self._link, pair))
+
+    def _add_tri(self, tri, cells):
+        owner = self.lighthouses[tri[0]].owner
+        self.tris[tri] = cells
+        for pos in tri:
+            self._tri_index.setdefault(pos, set()).add(tri)
+        self.rates[owner] += len(cells)
+        if self._listeners:
+            self._emit((TRIANGLE_ADD, tri, owner, cells))
+        if self._journal is not None:
+            self._journal.append((self._drop_tri, tri))
+
+    def _drop_tri(self, tri):
+        owner = self.lighthouses[tri[0]].owner
+        cells = self.tris.pop(tri)
+        for pos in tri:
+            _remove(self._tri_index, pos, tri)
+        self.rates[owner] -= len(cells)
+        if self._listeners:
+            self._emit((TRIANGLE_DROP, tri, owner, cells))
+        if self._journal is not None:
+            self._journal.append((self._add_tri, tri, cells))
+
+    def _unlink(self, pos):
+        for pair in list(self._conn_index.get(pos, ())):
+            self._cut(pair)
+        for tri in list(self._tri_index.get(pos, ())):
+            self._drop_tri(tri)
 
     def pre_round(self):
-        for pos in self.lighthouses:
-            for y in range(pos[1]-self.RDIST+1, pos[1]+self.RDIST):
-                for x in range(pos[0]-self.RDIST+1, pos[0]+self.RDIST):
-                    dist = geom.dist(pos, (x,y))
-                    delta = int(math.floor(self.RDIST - dist))
-                    if delta > 0:
-                        self.island.energy[x,y] += delta
+        self.island.regen(self.regen)
         player_posmap = dict()
         for player in self.players:
             if player.pos in player_posmap:
@@ -225,10 +666,79 @@ class Game(object):
             lh.decay(10)
 
     def post_round(self):
-        for lh in self.lighthouses.values():
-            if lh.owner is not None:
-                self.players[lh.owner].score += 2
-        for pair in self.conns:
-            self.players[self.lighthouses[next(iter(pair))].owner].score += 2
-        for tri, cells in self.tris.items():
-            self.players[self.lighthouses[tri[0]].owner].score += len(cells)
+        # 2 points per lighthouse and per connection, and 1 per triangle
+        # cell, as counted in rates
+        for player, rate in zip(self.players, self.rates):
+            player.score += rate
+
+    def clone(self):
+        # The map, lighthouse index and precomputed tables are shared with the
+        # clone; only the game state is copied
+        game = copy.copy(self)
+        game.island = self.island.clone()
+        game.lighthouses = dict((pos, lh.clone(game)) for pos, lh in self.lighthouses.items())
+        game.players = [player.clone(game) for player in self.players]
+        game.conns = set(self.conns)
+        game.tris = dict(self.tris)
+        game._conn_index = dict((pos, set(c)) for pos, c in self._conn_index.items())
+        game._tri_index = dict((pos, set(t)) for pos, t in self._tri_index.items())
+        game._conn_grid = self._conn_grid.copy()
+        game._snapshot = dict(self._snapshot)
+        game._dirty = set(self._dirty)
+        game.rates = list(self.rates)
+        game._listeners = []
+        game._journal = None
+        return game
+
+    # Make/unmake for search: apply(), apply_pre_round() and apply_post_round()
+    # do what play(), pre_round() and post_round() do and return a delta, and
+    # undo() reverts the most recent delta not yet undone. A command that
+    # raises MoveError leaves the game unchanged.
+    def _record(self, step, saved):
+        self._journal = []
+        try:
+            step()
+            return saved, self._journal
+        finally:
+            self._journal = None
+
+    def apply(self, player, move):
+        saved = [(player, player.pos, player.energy, set(player.keys))]
+        if player.pos in self.lighthouses:
+            lh = self.lighthouses[player.pos]
+            saved.append((lh, lh.owner, lh.energy))
+        return self._record(lambda: self.play(player, move), (None, saved))
+
+    def apply_pre_round(self):
+        saved = [(p, p.pos, p.energy, set(p.keys)) for p in self.players]
+        saved += [(lh, lh.owner, lh.energy) for lh in self.lighthouses.values()]
+        energy = self.island.save_regen(self.regen, set(p.pos for p in self.players))
+        return self._record(self.pre_round, (energy, saved))
+
+    def apply_post_round(self):
+        scores = [p.score for p in self.players]
+        self.post_round()
+        return scores, None
+
+    def undo(self, delta):
+        saved, journal = delta
+        if journal is None:
+            for player, score in zip(self.players, saved):
+                player.score = score
+            return
+        energy, objects = saved
+        if energy is not None:
+            self.island.restore_regen(energy)
+        # Owners first, so that connections and triangles come back under
+        # the owner they had
+        for entry in objects:
+            if isinstance(entry[0], Player):
+                player, player.pos, player.energy, player.keys = entry
+            else:
+                lh, owner, energy = entry
+                if lh.owner != owner or lh.energy != energy:
+                    lh._set_owner(owner)
+                    lh.energy = energy
+                    self._touch(lh.pos)
+        for entry in reversed(journal):
+            entry[0](*entry[1:])
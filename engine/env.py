@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+import json, random
+import engine, botplayer, mapcache
+
+# Reset/step wrapper around Game for training loops. One player is driven by
+# the caller; the others are bots run by the engine, given as bot classes
+# (subclasses of interface.Bot, run in-process) or as any bot spec accepted by
+# botplayer.make_player. Observations are the turn messages a bot receives
+# and actions are the commands a bot sends; the reward is the score the agent
+# gained since the previous step.
+#
+#   env = GameEnv("maps/island.txt", [RandBot])
+#   obs, info = env.reset(seed=1)
+#   while True:
+#       obs, reward, terminated, truncated, info = env.step(action)
+#       if terminated or truncated:
+#           break
+class GameEnv(object):
+    def __init__(self, mapfile, opponents=(), player=0, rounds=1000, lazy_energy=False):
+        self.config = mapcache.load(mapfile)
+        self.opponents = list(opponents)
+        self.player = player
+        self.rounds = rounds
+        self.lazy_energy = lazy_energy
+        self.game = None
+        self.actors = []
+
+    def _make_actor(self, num, opponent):
+        if isinstance(opponent, str):
+            return botplayer.make_player(self.game, num, opponent)
+        return botplayer.InProcessPlayer(self.game, num, opponent)
+
+    def _run(self, actors):
+        for actor in actors:
+            try:
+                actor.turn()
+            except botplayer.CommError:
+                actor.close()
+
+    def _observe(self):
+        return botplayer.turn_state(self.game, self.agent, self._public)
+
+    def _scores(self):
+        return [p.score for p in self.game.players]
+
+    def reset(self, seed=None):
+        if seed is not None:
+            random.seed(seed)
+        self.close()
+        self.game = engine.Game(self.config, len(self.opponents) + 1,
+                                lazy_energy=self.lazy_energy)
+        self.agent = self.game.players[self.player]
+        self.agent.name = "agent"
+        nums = [i for i in range(len(self.game.players)) if i != self.player]
+        self.actors = [self._make_actor(num, opponent)
+                       for num, opponent in zip(nums, self.opponents)]
+        for actor in self.actors:
+            try:
+                actor.initialize()
+            except botplayer.CommError:
+                actor.close()
+        self.round = 0
+        self._public = dict()
+        # Opponents seated before the agent play their turn before it
+        self._before = [a for a in self.actors if a.player.num < self.player]
+        self._after = [a for a in self.actors if a.player.num > self.player]
+        self.game.pre_round()
+        self._run(self._before)
+        init = json.loads(json.dumps(botplayer.init_message(self.game, self.agent)))
+        return self._observe(), {"init": init, "round": 0, "scores": self._scores()}
+
+    def step(self, action):
+        if self.game is None:
+            raise engine.GameError("step() called before reset()")
+        if self.round >= self.rounds:
+            raise engine.GameError("Episode is over, call reset()")
+        score = self.agent.score
+        if not isinstance(action, dict) or "command" not in action:
+            result = {"success": False, "message": "Invalid command structure"}
+        else:
+            try:
+                self.game.play(self.agent, action)
+                result = {"success": True}
+            except engine.MoveError as e:
+                result = {"success": False, "message": str(e)}
+        self._run(self._after)
+        self.game.post_round()
+        self.round += 1
+        truncated = self.round >= self.rounds
+        reward = self.agent.score - score
+        if not truncated:
+            self.game.pre_round()
+            self._run(self._before)
+        info = dict(result, round=self.round, scores=self._scores())
+        return self._observe(), reward, False, truncated, info
+
+    def close(self):
+        for actor in self.actors:
+            actor.close()
+        self.actors = []
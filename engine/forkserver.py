@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+# Fork server for Python bots, started by botpool.ForkServer as
+#   python3 forkserver.py <control fd> <bot script> [args...]
+# It loads the bot script once (with __name__ set to "__forkserver__", so the
+# usual `if __name__ == "__main__"` block does not run) and then forks a copy
+# of itself for every bot process requested, which runs the script as
+# __main__ with the module imports already done.
+#
+# Control protocol (Unix stream socket):
+#   engine -> server: b"S" carrying the bot's stdin and stdout fds
+#   server -> engine: b"ready\n" once the script is loaded
+#                     b"pid <pid>\n" once forked, in request order
+#                     b"exit <pid> <code>\n" when a bot process exits
+
+import sys, os, socket, signal, runpy, selectors, traceback
+
+def _run_child(script, fds, sel, closefds):
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    sel.close()
+    for fd in closefds:
+        os.close(fd)
+    os.dup2(fds[0], 0)
+    os.dup2(fds[1], 1)
+    os.close(fds[0])
+    os.close(fds[1])
+    sys.stdin = os.fdopen(0, "r")
+    sys.stdout = os.fdopen(1, "w")
+    code = 0
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            sys.stderr.write("%s\n" % e.code)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    try:
+        sys.stdout.flush()
+    except Exception:
+        pass
+    os._exit(code)
+
+def main():
+    ctl = socket.socket(fileno=int(sys.argv[1]))
+    script = sys.argv[2]
+    sys.argv = sys.argv[2:]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    runpy.run_path(script, run_name="__forkserver__")
+    ctl.sendall(b"ready\n")
+
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    sel = selectors.DefaultSelector()
+    sel.register(ctl, selectors.EVENT_READ)
+    sel.register(wake_r, selectors.EVENT_READ)
+
+    while True:
+        for key, events in sel.select():
+            if key.fileobj is ctl:
+                try:
+                    msg, fds, flags, addr = socket.recv_fds(ctl, 1, 2)
+                except OSError:
+                    return
+                if not msg:
+                    return
+                pid = os.fork()
+                if pid == 0:
+                    _run_child(script, fds, sel, (ctl.fileno(), wake_r, wake_w))
+                for fd in fds:
+                    os.close(fd)
+                ctl.sendall(b"pid %d\n" % pid)
+            else:
+                os.read(wake_r, 512)
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            ctl.sendall(b"exit %d %d\n" % (pid, os.waitstatus_to_exitcode(status)))
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,109 @@
 #!/usr/bin/python3
 
-import sys, time
-import engine, botplayer
-import view
+import os, sys, time
+import engine, botplayer, metrics
 
 cfg_file = sys.argv[1]
 bots = sys.argv[2:]
 DEBUG = False
 CONTINUE_ON_ERROR = False
+LAZY_ENERGY = False
+# Render from a separate process at a capped frame rate instead of after
+# every turn
+DETACHED_VIEW = False
+# Record the match to this file (see replay.py)
+REPLAY_FILE = None
+KEYFRAME_INTERVAL = 100
+# Phase latencies and bot error counts (see metrics.py), written when the game
+# ends and every METRICS_INTERVAL seconds
+METRICS_JSON = None
+METRICS_PROM = None
+METRICS_INTERVAL = 10.0
+# Judge bot timeouts on CPU time instead of wall time (see
+# BotPlayer.CPU_TIMEOUTS), but never wait more than WALL_CAP_FACTOR times the
+# hard timeout of wall time, and run the engine and its bots on these CPUs
+# only, e.g. {2, 3}
+CPU_TIMEOUTS = False
+WALL_CAP_FACTOR = 2.0
+CPUS = None
+
+botplayer.BotPlayer.CPU_TIMEOUTS = CPU_TIMEOUTS
+botplayer.BotPlayer.WALL_CAP_FACTOR = WALL_CAP_FACTOR
+if CPUS is not None:
+    os.sched_setaffinity(0, CPUS)
 
 config = engine.GameConfig(cfg_file)
-game = engine.Game(config, len(bots))
-actors = [botplayer.BotPlayer(game, i, cmdline, debug=DEBUG) for i, cmdline in enumerate(bots)]
+game = engine.Game(config, len(bots), lazy_energy=LAZY_ENERGY)
+if DETACHED_VIEW:
+    import liveview
+    view = liveview.LiveView()
+    view.watch(game)
+actors = []
+for i, cmdline in enumerate(bots):
+    try:
+        actors.append(botplayer.make_player(game, i, cmdline, debug=DEBUG))
+    except botplayer.CommError as e:
+        if not CONTINUE_ON_ERROR:
+            raise
+        print("CommError: " + str(e))
+        actors.append(botplayer.DeadPlayer(game, i))
+
+stats = metrics.NULL
+if METRICS_JSON is not None or METRICS_PROM is not None:
+    stats = metrics.Metrics(METRICS_JSON, METRICS_PROM, METRICS_INTERVAL)
+stats.watch(actors)
 
 for actor in actors:
-    actor.initialize()
+    try:
+        actor.initialize()
+    except botplayer.CommError as e:
+        if not CONTINUE_ON_ERROR:
+            raise
+        print("CommError: " + str(e))
+        actor.close()
 
-view = view.GameView(game)
+recorder = None
+if REPLAY_FILE is not None:
+    import replay
+    recorder = replay.ReplayWriter(REPLAY_FILE, cfg_file, game, KEYFRAME_INTERVAL)
+    for actor in actors:
+        actor.recorder = recorder
+
+if not DETACHED_VIEW:
+    import view
+    view = view.GameView(game)
 
 round = 0
-while True:
-    game.pre_round()
-    view.update()
-    for actor in actors:
-        try:
-            actor.turn()
-        except botplayer.CommError as e:
-            if not CONTINUE_ON_ERROR:
-                raise
-            else:
-                print("CommError: " + str(e))
-                actor.close()
-        view.update()
-    game.post_round()
-    s = "########### ROUND %d SCORE: " % round
-    for i in range(len(bots)):
-        s += "P%d: %d " % (i, game.players[i].score)
-    print(s)
-    round += 1
+try:
+    while True:
+        if recorder is not None:
+            recorder.begin_round()
+        with stats.phase("pre_round"):
+            game.pre_round()
+        with stats.phase("view"):
+            view.update()
+        for actor in actors:
+            try:
+                actor.turn()
+            except botplayer.CommError as e:
+                if not CONTINUE_ON_ERROR:
+                    raise
+                else:
+                    print("CommError: " + str(e))
+                    actor.close()
+            with stats.phase("view"):
+                view.update()
+        with stats.phase("post_round"):
+            game.post_round()
+        s = "########### ROUND %d SCORE: " % round
+        for i in range(len(bots)):
+            s += "P%d: %d " % (i, game.players[i].score)
+        print(s)
+        round += 1
+        stats.tick()
+finally:
+    if recorder is not None:
+        recorder.close()
+    stats.export()
 
 view.update()
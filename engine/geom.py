@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 import math
+import numpy as np
 
 def dist(a, b):
     x0, y0 = a
@@ -19,6 +20,60 @@ def intersect(j, k):
         orient2d(k1, k2, j1) * orient2d(k1, k2, j2) < 0 and
         orient2d(j1, j2, k1) * orient2d(j1, j2, k2) < 0)
 
+# Uniform grid of buckets holding the segments that pass through them. Two
+# segments that cross share at least the bucket holding the crossing point, so
+# candidates() returns a superset of the segments that can intersect a query.
+class SegmentGrid(object):
+    def __init__(self, size=8):
+        self.size = size
+        self._buckets = dict()
+        self._cells = dict()
+
+    def _cells_for(self, a, b):
+        s = self.size
+        (x0, y0), (x1, y1) = sorted((a, b))
+        dx, dy = x1 - x0, y1 - y0
+        if dx == 0:
+            ya, yb = sorted((y0, y1))
+            return [(x0 // s, j) for j in range(ya // s, yb // s + 1)]
+        cells = []
+        for i in range(x0 // s, x1 // s + 1):
+            xa = max(x0, i * s)
+            xb = min(x1, (i + 1) * s)
+            # Bucket rows at both ends of this column strip, in exact integers
+            ja = (y0 * dx + (xa - x0) * dy) // (dx * s)
+            jb = (y0 * dx + (xb - x0) * dy) // (dx * s)
+            if ja > jb:
+                ja, jb = jb, ja
+            cells.extend((i, j) for j in range(ja, jb + 1))
+        return cells
+
+    def add(self, key, a, b):
+        cells = self._cells_for(a, b)
+        self._cells[key] = cells
+        for cell in cells:
+            self._buckets.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        for cell in self._cells.pop(key):
+            bucket = self._buckets[cell]
+            bucket.remove(key)
+            if not bucket:
+                del self._buckets[cell]
+
+    def copy(self):
+        grid = SegmentGrid(self.size)
+        grid._cells = dict(self._cells)
+        grid._buckets = dict((cell, set(keys)) for cell, keys in self._buckets.items())
+        return grid
+
+    def candidates(self, a, b):
+        found = set()
+        for cell in self._cells_for(a, b):
+            if cell in self._buckets:
+                found.update(self._buckets[cell])
+        return found
+
 def _bias(p0, p1):
     if (p0[1] == p1[1] and p0[0] > p1[0]) or p0[1] > p1[1]:
         return 0
@@ -42,6 +97,42 @@ def render(points):
             if w0 >= 0 and w1 >= 0 and w2 >= 0:
                 yield p
 
+def render_mask(points):
+    v0, v1, v2 = points
+    if orient2d(v0, v1, v2) < 0:
+        v0, v1 = v1, v0
+    x0 = min(v0[0], v1[0], v2[0])
+    x1 = max(v0[0], v1[0], v2[0])
+    y0 = min(v0[1], v1[1], v2[1])
+    y1 = max(v0[1], v1[1], v2[1])
+    xs = np.arange(x0, x1 + 1)[None, :]
+    ys = np.arange(y0, y1 + 1)[:, None]
+    mask = np.ones((y1 - y0 + 1, x1 - x0 + 1), dtype=bool)
+    for a, b in ((v1, v2), (v2, v0), (v0, v1)):
+        w = (b[0] - a[0]) * (ys - a[1]) - (xs - a[0]) * (b[1] - a[1])
+        mask &= w + _bias(a, b) >= 0
+    return (x0, y0), mask
+
+# Compact set of cells, stored as a boolean mask over a bounding box
+class CellMask(object):
+    def __init__(self, origin, mask):
+        self.origin = origin
+        self.mask = mask
+        self.count = int(mask.sum())
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, pos):
+        x = pos[0] - self.origin[0]
+        y = pos[1] - self.origin[1]
+        h, w = self.mask.shape
+        return 0 <= x < w and 0 <= y < h and bool(self.mask[y, x])
+
+    def __iter__(self):
+        x0, y0 = self.origin
+        for y, x in zip(*np.nonzero(self.mask)):
+            yield x0 + int(x), y0 + int(y)
 
 def _rendertest(points):
     w = 1+max(p[0] for p in points)
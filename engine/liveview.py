@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+import os, time, queue, multiprocessing
+import engine
+
+# Shows a match from a separate viewer process, so that rendering never slows
+# down the simulation. The engine side only copies the game state into a
+# snapshot, at most FPS times per second, and hands it over through a small
+# bounded queue without waiting; when the viewer falls behind, snapshots are
+# dropped and it renders the newest one it has.
+#
+# The viewer is forked when LiveView is created, so create it before starting
+# bots or other threads.
+
+def snapshot(game):
+    tris = dict((tri, (game.lighthouses[tri[0]].owner, cells))
+                for tri, cells in game.tris.items())
+    return (game.island.energy_array().copy(),
+            [p.pos for p in game.players],
+            dict((pos, lh.owner) for pos, lh in game.lighthouses.items()),
+            # Endpoints in drawing order, which pickling a frozenset may not keep
+            set(tuple(pair) for pair in game.conns),
+            tris)
+
+class _Mirror(object):
+    # Game look-alike rebuilt from snapshots, for view.GameView. Triangles
+    # that did not change keep their CellMask, which is how GameView tells
+    # them apart.
+    def __init__(self, island_map, numplayers):
+        self.island = engine.Island(island_map)
+        self.players = [engine.Player(self, i, None) for i in range(numplayers)]
+        self.lighthouses = dict()
+        self.conns = set()
+        self.tris = dict()
+        self._tri_owners = dict()
+
+    def apply(self, frame):
+        energy, positions, owners, conns, tris = frame
+        self.island.load_energy(energy)
+        for player, pos in zip(self.players, positions):
+            player.pos = pos
+        for pos, owner in owners.items():
+            if pos not in self.lighthouses:
+                self.lighthouses[pos] = engine.Lighthouse(self, pos)
+            self.lighthouses[pos].owner = owner
+        self.conns = conns
+        current = dict()
+        for tri, (owner, cells) in tris.items():
+            if tri in self.tris and self._tri_owners[tri] == owner:
+                current[tri] = self.tris[tri]
+            else:
+                current[tri] = cells
+        self.tris = current
+        self._tri_owners = dict((tri, owner) for tri, (owner, cells) in tris.items())
+
+def _viewer(frames, fps):
+    # Keeps pygame's banner off stdout, which may carry results
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+    import view
+    gv = None
+    mirror = None
+    period = 1.0 / fps
+    done = False
+    while not done:
+        st = time.monotonic()
+        msg = frames.get()
+        frame = None
+        while True:
+            if msg is None:
+                done = True
+                break
+            kind, data = msg
+            if kind == "game":
+                mirror = _Mirror(*data)
+                gv = view.GameView(mirror)
+                frame = None
+            else:
+                frame = data
+            try:
+                msg = frames.get_nowait()
+            except queue.Empty:
+                break
+        if frame is not None and gv is not None:
+            mirror.apply(frame)
+            gv.update()
+        if gv is not None:
+            view.pygame.event.pump()
+        time.sleep(max(0, st + period - time.monotonic()))
+
+class LiveView(object):
+    FPS = 30
+    QUEUE_SIZE = 2
+    CLOSE_TIMEOUT = 2.0
+
+    def __init__(self, fps=FPS):
+        ctx = multiprocessing.get_context("fork")
+        self.frames = ctx.Queue(self.QUEUE_SIZE)
+        self.proc = ctx.Process(target=_viewer, args=(self.frames, fps),
+                                name="LiveView", daemon=True)
+        self.proc.start()
+        self.period = 1.0 / fps
+        self.game = None
+        self.next_frame = 0
+        self.dropped = 0
+
+    def watch(self, game):
+        self.game = game
+        self.next_frame = 0
+        self.frames.put(("game", (game.island.mask.tolist(), len(game.players))))
+
+    def update(self):
+        now = time.monotonic()
+        if self.game is None or now < self.next_frame:
+            return
+        try:
+            self.frames.put_nowait(("frame", snapshot(self.game)))
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.next_frame = now + self.period
+
+    def close(self):
+        # Shows the final state, then lets the viewer exit
+        if self.proc is None:
+            return
+        try:
+            if self.game is not None:
+                self.frames.put(("frame", snapshot(self.game)), timeout=self.CLOSE_TIMEOUT)
+            self.frames.put(None, timeout=self.CLOSE_TIMEOUT)
+        except queue.Full:
+            pass
+        self.proc.join(self.CLOSE_TIMEOUT)
+        if self.proc.is_alive():
+            self.proc.terminate()
+        self.proc = None
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+import os, sys, json, mmap, struct, hashlib, time
+import numpy as np
+import engine
+
+# Compiled maps. Everything a Game derives from its map (land mask, horizon,
+# regen field, blocked lighthouse pairs) is computed once and written next to
+# the map, in CACHE_DIR, as raw arrays behind a JSON header:
+#
+#   MAGIC, u32 header length, JSON header, arrays at ALIGN-byte offsets
+#
+# load() memory-maps the file read-only, so every match worker on the host
+# shares the same pages, and every game in a process shares the same arrays.
+# The header holds a hash of the map text and of the engine constants the
+# tables depend on; a file that does not match is compiled again.
+
+MAGIC = b"LHMC\x01"
+VERSION = 2
+ALIGN = 64
+CACHE_DIR = "__mapcache__"
+
+_loaded = dict()
+
+def _key(source):
+    h = hashlib.sha256(source)
+    h.update(b"|%d|%d|%d" % (VERSION, engine.Game.RDIST, engine.Island.HORIZON))
+    return h.hexdigest()
+
+def cache_path(mapfile):
+    directory, name = os.path.split(os.path.abspath(mapfile))
+    return os.path.join(directory, CACHE_DIR, os.path.splitext(name)[0] + ".lhm")
+
+def _tables(cfg):
+    game = engine.Game(cfg)
+    return {
+        "mask": game.island.mask,
+        "horizon": engine.Island.horizon_mask(),
+        "regen": game.regen,
+        "blocked": game.blocked,
+    }
+
+def _write(path, key, cfg, tables):
+    header = {
+        "key": key,
+        "lighthouses": cfg.lighthouses,
+        "players": cfg.players,
+        "arrays": dict(),
+    }
+    offset = 0
+    for name, array in sorted(tables.items()):
+        header["arrays"][name] = [array.dtype.str, array.shape, offset]
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    data = json.dumps(header).encode("utf-8")
+    start = -(-(len(MAGIC) + 4 + len(data)) // ALIGN) * ALIGN
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written aside and renamed, so concurrent workers never see half a file
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as fd:
+        fd.write(MAGIC + struct.pack("<I", len(data)) + data)
+        for name, array in sorted(tables.items()):
+            fd.seek(start + header["arrays"][name][2])
+            fd.write(np.ascontiguousarray(array).tobytes())
+        fd.truncate(start + offset)
+    os.replace(tmp, path)
+
+def _read(path, key):
+    # The compiled config, or None if the file is missing or stale
+    try:
+        with open(path, "rb") as fd:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        if mm[:len(MAGIC)] != MAGIC:
+            return None
+        size, = struct.unpack_from("<I", mm, len(MAGIC))
+        header = json.loads(mm[len(MAGIC) + 4:len(MAGIC) + 4 + size].decode("utf-8"))
+        if header["key"] != key:
+            return None
+        start = -(-(len(MAGIC) + 4 + size) // ALIGN) * ALIGN
+        tables = dict()
+        for name, (dtype, shape, offset) in header["arrays"].items():
+            count = int(np.prod(shape))
+            tables[name] = np.frombuffer(mm, dtype=dtype, count=count,
+                                         offset=start + offset).reshape(shape)
+    except (ValueError, KeyError, struct.error):
+        return None
+    cfg = engine.GameConfig.__new__(engine.GameConfig)
+    cfg.lighthouses = [tuple(p) for p in header["lighthouses"]]
+    cfg.players = [tuple(p) for p in header["players"]]
+    cfg.island = tables["mask"].astype(np.uint8).tolist()
+    cfg.tables = tables
+    return cfg
+
+def compile_map(mapfile, path=None):
+    with open(mapfile, "rb") as fd:
+        source = fd.read()
+    cfg = engine.GameConfig.from_text(source.decode("utf-8"))
+    path = path or cache_path(mapfile)
+    _write(path, _key(source), cfg, _tables(cfg))
+    return path
+
+def load(mapfile):
+    # GameConfig for mapfile with its tables attached, compiled if needed
+    with open(mapfile, "rb") as fd:
+        source = fd.read()
+    key = _key(source)
+    path = cache_path(mapfile)
+    cached = _loaded.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    cfg = _read(path, key)
+    if cfg is None:
+        parsed = engine.GameConfig.from_text(source.decode("utf-8"))
+        tables = _tables(parsed)
+        try:
+            _write(path, key, parsed, tables)
+            cfg = _read(path, key)
+        except OSError as e:
+            sys.stderr.write("Cannot write compiled map %r: %s\n" % (path, e))
+        if cfg is None:
+            parsed.tables = tables
+            cfg = parsed
+    _loaded[path] = (key, cfg)
+    return cfg
+
+if __name__ == "__main__":
+    # mapcache.py <map>...: compile maps ahead of time
+    for mapfile in sys.argv[1:]:
+        st = time.time()
+        path = compile_map(mapfile)
+        print("%s -> %s (%.3fs)" % (mapfile, path, time.time() - st))
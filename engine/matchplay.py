@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+import time
+import engine, botplayer, mapcache, metrics
+from botplayer import CommError
+
+# One match as the tournament drivers play it (tournament.run_match,
+# multiplex.play_match): the game, the actors seated in it and the result
+# they report. The match itself is written once, in calls(), as the sequence
+# of actor calls it makes; the drivers only make those calls, synchronously
+# (run) or awaiting them (multiplex).
+class Match(object):
+    def __init__(self, mapfile, bots, rounds, lazy_energy=False, instrument=False):
+        self.result = {
+            "map": mapfile,
+            "bots": list(bots),
+            "rounds": rounds,
+            "errors": [None] * len(bots),
+            "turn_time": [0.0] * len(bots),
+        }
+        self.st = time.time()
+        self.bots = list(bots)
+        self.rounds = rounds
+        self.game = engine.Game(mapcache.load(mapfile), len(bots), lazy_energy=lazy_energy)
+        self.instrument = instrument
+        self.stats = metrics.Metrics() if instrument else metrics.NULL
+        self.actors = []
+
+    def seat(self, make, dead):
+        # make(game, num, bot) creates each actor. A bot that cannot be
+        # created is recorded and seated as dead(game, num), which never plays.
+        for i, bot in enumerate(self.bots):
+            try:
+                actor = make(self.game, i, bot)
+            except CommError as e:
+                self.result["errors"][i] = "start: %s" % e
+                actor = dead(self.game, i)
+            self.actors.append(actor)
+        self.stats.watch(self.actors)
+
+    def calls(self, view=None):
+        # Yields (actor, method name) for every call the match makes, and is
+        # sent back the CommError the call raised, or None. An actor that
+        # fails is closed and plays no more.
+        result = self.result
+        for stage in ("start", "initialize"):
+            for i, actor in enumerate(self.actors):
+                error = yield actor, stage
+                if error is not None:
+                    result["errors"][i] = "%s: %s" % ("init" if stage == "initialize" else stage, error)
+                    yield actor, "close"
+        result["init_time"] = time.time() - self.st
+        for round in range(self.rounds):
+            with self.stats.phase("pre_round"):
+                self.game.pre_round()
+            for i, actor in enumerate(self.actors):
+                t = time.time()
+                error = yield actor, "turn"
+                if error is not None:
+                    result["errors"][i] = "round %d: %s" % (round, error)
+                    yield actor, "close"
+                result["turn_time"][i] += time.time() - t
+                if view is not None:
+                    with self.stats.phase("view"):
+                        view.update()
+            with self.stats.phase("post_round"):
+                self.game.post_round()
+
+    def run(self, view=None):
+        # Plays the match with synchronous actors
+        calls = self.calls(view)
+        error = None
+        while True:
+            try:
+                actor, method = calls.send(error)
+            except StopIteration:
+                return
+            error = None
+            try:
+                getattr(actor, method)()
+            except CommError as e:
+                error = e
+
+    def finish(self):
+        # The result, once every actor is closed
+        result = self.result
+        result["io"] = [actor.io_totals() for actor in self.actors]
+        if botplayer.BotPlayer.CPU_TIMEOUTS:
+            result["cpu_time"] = [actor.cpu_total for actor in self.actors]
+        result["names"] = [p.name for p in self.game.players]
+        result["scores"] = [p.score for p in self.game.players]
+        result["time"] = time.time() - self.st
+        if self.instrument:
+            result["metrics"] = self.stats.report()
+        return result
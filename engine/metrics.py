@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+
+import os, time, json, bisect, contextlib
+
+# Match instrumentation. Durations go into histograms with fixed power-of-two
+# buckets (BOUNDS, about 1us to 16s), one per phase and, for bot phases, per
+# player:
+#
+#   pre_round, post_round   Game.pre_round and Game.post_round
+#   view                    one view update
+#   bot_send                building and writing the turn message
+#   bot_think               from the message written to the reply readable
+#   bot_receive             reading and decoding the reply
+#   bot_play                applying the command to the game
+#   bot_cpu                 CPU time the bot process used for its reply, when
+#                           timeouts are judged on CPU time
+#
+# Soft and hard timeouts and move errors are counted by every BotPlayer
+# (BotPlayer.events) and collected from the players passed to watch().
+#
+# Nothing is measured unless a Metrics object is used: players only time
+# their turns when their metrics attribute is set, and drivers use NULL,
+# whose phase() does nothing, when instrumentation is off.
+
+BOUNDS = [2.0 ** k for k in range(-20, 5)]
+PREFIX = "lighthouses"
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-quantile
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BOUNDS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def report(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": self.counts,
+        }
+
+    def merge(self, report):
+        self.counts = [a + b for a, b in zip(self.counts, report["buckets"])]
+        self.count += report["count"]
+        self.sum += report["sum"]
+        self.max = max(self.max, report["max"])
+
+def _labels(**labels):
+    return ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for k, v in labels.items())
+
+class Metrics(object):
+    def __init__(self, json_path=None, prom_path=None, interval=None):
+        self.json_path = json_path
+        self.prom_path = prom_path
+        self.interval = interval
+        self.histograms = dict()
+        self.events = dict()
+        self.actors = []
+        self._exported = time.monotonic()
+
+    def watch(self, actors):
+        for actor in actors:
+            actor.metrics = self
+            self.actors.append(actor)
+
+    def observe(self, phase, seconds, player=None):
+        # Bot phases are labelled with the player number and bot name
+        key = (phase, None, None) if player is None else (phase, player.num, player.name)
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = Histogram()
+        h.observe(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        st = time.monotonic()
+        yield
+        self.observe(name, time.monotonic() - st)
+
+    def bot_turn(self, player, send, think, receive, play, cpu=None):
+        self.observe("bot_send", send, player)
+        self.observe("bot_think", think, player)
+        if receive is not None:
+            self.observe("bot_receive", receive, player)
+        self.observe("bot_play", play, player)
+        if cpu is not None:
+            self.observe("bot_cpu", cpu, player)
+
+    def _events(self):
+        events = dict(self.events)
+        for actor in self.actors:
+            key = (actor.player.num, actor.player.name)
+            counts = events.get(key, dict())
+            events[key] = dict((k, counts.get(k, 0) + v) for k, v in actor.events.items())
+        return events
+
+    def report(self):
+        phases = []
+        def order(key):
+            phase, num, name = key
+            return phase, -1 if num is None else num, name or ""
+        for phase, num, name in sorted(self.histograms, key=order):
+            h = self.histograms[phase, num, name]
+            entry = {"phase": phase}
+            if num is not None:
+                entry["player"] = num
+                entry["bot"] = name
+            entry.update(h.report())
+            phases.append(entry)
+        bots = [dict(counts, player=num, bot=name)
+                for (num, name), counts in sorted(self._events().items())]
+        return {"bounds": BOUNDS, "phases": phases, "bots": bots}
+
+    def merge(self, report):
+        # Adds a report from another Metrics, e.g. one match of a tournament
+        for entry in report["phases"]:
+            key = (entry["phase"], entry.get("player"), entry.get("bot"))
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram()
+            h.merge(entry)
+        for entry in report["bots"]:
+            key = (entry["player"], entry["bot"])
+            counts = self.events.setdefault(key, dict())
+            for k, v in entry.items():
+                if k not in ("player", "bot"):
+                    counts[k] = counts.get(k, 0) + v
+
+    def prometheus(self):
+        # Prometheus text exposition format
+        name = PREFIX + "_phase_seconds"
+        lines = [
+            "# HELP %s Duration of engine and bot phases." % name,
+            "# TYPE %s histogram" % name,
+        ]
+        for entry in self.report()["phases"]:
+            labels = {"phase": entry["phase"]}
+            if "player" in entry:
+                labels["player"] = entry["player"]
+                labels["bot"] = entry["bot"]
+            seen = 0
+            for bound, n in zip(BOUNDS + ["+Inf"], entry["buckets"]):
+                seen += n
+                lines.append("%s_bucket{%s} %d" % (name, _labels(**labels, le=bound), seen))
+            lines.append("%s_sum{%s} %r" % (name, _labels(**labels), entry["sum"]))
+            lines.append("%s_count{%s} %d" % (name, _labels(**labels), entry["count"]))
+        name = PREFIX + "_bot_events_total"
+        lines += [
+            "# HELP %s Bot timeouts and move errors." % name,
+            "# TYPE %s counter" % name,
+        ]
+        for (num, bot), counts in sorted(self._events().items()):
+            for event, n in sorted(counts.items()):
+                lines.append("%s{%s} %d" % (name, _labels(player=num, bot=bot, event=event), n))
+        return "\n".join(lines) + "\n"
+
+    def _write(self, path, data):
+        # Replaced atomically, so scrapers never read half a file
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as fd:
+            fd.write(data)
+        os.replace(tmp, path)
+
+    def export(self):
+        if self.json_path is not None:
+            self._write(self.json_path, json.dumps(self.report(), indent=1) + "\n")
+        if self.prom_path is not None:
+            self._write(self.prom_path, self.prometheus())
+        self._exported = time.monotonic()
+
+    def tick(self):
+        # Called once per round; exports every `interval` seconds
+        if self.interval is not None and time.monotonic() - self._exported >= self.interval:
+            self.export()
+
+class _NullMetrics(object):
+    def phase(self, name):
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+    def watch(self, actors):
+        pass
+
+    def tick(self):
+        pass
+
+    def export(self):
+        pass
+
+NULL = _NullMetrics()
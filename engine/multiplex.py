@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+import sys, time, json, socket, asyncio
+import botplayer, matchplay
+from botplayer import CommError
+
+# Runs many matches in a single process. Every bot pipe or socket is served by
+# one asyncio event loop, so while one match waits for a bot to think the
+# engine keeps stepping the others. Within a match, bots still play strictly
+# in player order with the same soft/hard timeouts as BotPlayer.
+
+class AsyncBotPlayer(botplayer.BotPlayer):
+    STREAM_LIMIT = 1 << 24
+
+    def _spawn(self, cmdline):
+        self.cmdline = cmdline
+        self.p = None
+        self._writer = None
+
+    async def start(self):
+        address = botplayer.parse_address(self.cmdline)
+        if address is None:
+            self.p = await asyncio.create_subprocess_shell(
+                self.cmdline, stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE, limit=self.STREAM_LIMIT)
+            self._reader, self._writer = self.p.stdout, self.p.stdin
+            return
+        family, addr = address
+        try:
+            if family == socket.AF_UNIX:
+                conn = asyncio.open_unix_connection(addr, limit=self.STREAM_LIMIT)
+            else:
+                conn = asyncio.open_connection(*addr, limit=self.STREAM_LIMIT)
+            self._reader, self._writer = await asyncio.wait_for(conn, self.INIT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.alive = False
+            raise CommError("Cannot connect to %s: %s" % (self.cmdline, e))
+
+    async def _send(self, data):
+        await self._write(json.dumps(data).encode("ascii"))
+
+    async def _write(self, line):
+        assert b"\n" not in line
+        if self.debug:
+            print(">>P%d: %r" % (self.player.num, line))
+        try:
+            self._writer.write(line + b"\n")
+            await self._writer.drain()
+        except:
+            raise CommError("Error sending data")
+        self.io["writes"] += 1
+        self.io["bytes_out"] += len(line) + 1
+
+    def _bot_pid(self):
+        return None if self.p is None else self.p.pid
+
+    async def _recv(self, soft_timeout, hard_timeout):
+        # BotPlayer._recv, waiting on the stream instead of select()
+        st = time.monotonic()
+        ht = st + hard_timeout
+        cpu = self._cpu_begin()
+        try:
+            line = self._line()
+            while line is None:
+                reading = asyncio.ensure_future(self._reader.read(self.READ_SIZE))
+                while True:
+                    done, pending = await asyncio.wait((reading,), timeout=max(0, ht - time.monotonic()))
+                    if done:
+                        break
+                    try:
+                        ht = self._hard_deadline(st, cpu, hard_timeout)
+                    except CommError:
+                        reading.cancel()
+                        raise
+                line = self._feed(reading.result())
+        except Exception as e:
+            raise CommError("Unknown error: %r" % e)
+        return self._reply(line, st, cpu, soft_timeout)
+
+    async def initialize(self):
+        if not self.alive:
+            return
+        self._io_begin()
+        await self._send(self._init_message())
+        self._greeted(await self._recv(self.INIT_TIMEOUT, self.INIT_TIMEOUT))
+
+    async def turn(self):
+        if not self.alive:
+            return
+        self._io_begin()
+        st = time.monotonic()
+        await self._write(self._state())
+        sent = time.monotonic()
+        move = await self._recv(self.MOVE_TIMEOUT, self.MOVE_HARDTIMEOUT)
+        await self._send(self._finish_turn(move, st, sent))
+
+    async def _reap(self, timeout):
+        try:
+            await asyncio.wait_for(self.p.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def close(self):
+        if self.alive:
+            self.alive = False
+            if self._writer is None:
+                return
+            try:
+                self._writer.close()
+            except OSError:
+                pass
+            if self.p is None:
+                sys.stderr.write("Bot %r session closed\n" % self.player.name)
+                return
+            if not await self._reap(1.0):
+                self.p.terminate()
+                if not await self._reap(1.0):
+                    self.p.kill()
+                    await self.p.wait()
+            sys.stderr.write("Bot %r exit code: %r\n" % (self.player.name, self.p.returncode))
+
+    def __del__(self):
+        # close() is a coroutine, awaited by play_match; the loop that owns
+        # the subprocess may already be closed here
+        pass
+
+class AsyncInProcessPlayer(botplayer.InProcessPlayer):
+    # In-process bots run synchronously; this only gives them the same
+    # coroutine methods as AsyncBotPlayer
+    async def start(self):
+        pass
+
+    async def initialize(self):
+        botplayer.InProcessPlayer.initialize(self)
+
+    async def turn(self):
+        botplayer.InProcessPlayer.turn(self)
+
+    async def close(self):
+        botplayer.InProcessPlayer.close(self)
+
+    def __del__(self):
+        botplayer.InProcessPlayer.close(self)
+
+class AsyncDeadPlayer(botplayer.DeadPlayer):
+    async def start(self):
+        pass
+
+    async def initialize(self):
+        pass
+
+    async def turn(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def __del__(self):
+        pass
+
+def _make_player(game, num, spec):
+    if spec.startswith("py:"):
+        return AsyncInProcessPlayer(game, num, botplayer.load_bot(spec))
+    return AsyncBotPlayer(game, num, spec)
+
+async def play_match(mapfile, bots, rounds, lazy_energy=False, instrument=False):
+    # matchplay.Match.run, awaiting every call
+    m = matchplay.Match(mapfile, bots, rounds, lazy_energy, instrument)
+    try:
+        m.seat(_make_player, AsyncDeadPlayer)
+        calls = m.calls()
+        error = None
+        while True:
+            try:
+                actor, method = calls.send(error)
+            except StopIteration:
+                break
+            error = None
+            try:
+                await getattr(actor, method)()
+            except CommError as e:
+                error = e
+    finally:
+        await asyncio.gather(*[actor.close() for actor in m.actors])
+    return m.finish()
+
+async def _play(sem, mapfile, bots, rounds, lazy_energy, instrument=False):
+    async with sem:
+        try:
+            return await play_match(mapfile, bots, rounds, lazy_energy, instrument)
+        except Exception as e:
+            return {"map": mapfile, "bots": list(bots), "rounds": rounds,
+                    "failed": "%s: %s" % (type(e).__name__, e)}
+
+async def _play_all(tasks, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[_play(sem, *task) for task in tasks])
+
+def run_matches(tasks, concurrency=100):
+    return asyncio.run(_play_all(tasks, concurrency))
@@ -0,0 +1,314 @@
+#!/usr/bin/python3
+
+import io, json, zlib, struct, bisect
+import numpy as np
+import engine
+
+# Match replays. A replay file holds the map and every turn played, plus a
+# keyframe with the full game state every KEYFRAME_INTERVAL rounds, so the
+# state at any round is rebuilt from the closest keyframe by replaying at
+# most that many rounds through the engine.
+#
+#   MAGIC, u32 header length, zlib-compressed JSON header
+#   records: tag byte, u32 payload length, payload
+#     R  start of a round: u32 round number
+#     K  keyframe: state at the start of the round, before pre_round (npz)
+#     M  error message, numbered in order of appearance
+#     T  turn: u8 player, u8 success, u8 opcode, arguments, u32 message
+#        number when not successful (u16 in version 1 files)
+#     I  index, written on close: u32 rounds, u32 keyframes, the offset of
+#        every R record, (round, offset) for every K record, then the
+#        messages as a JSON list
+#   trailer: u64 offset of the I record, INDEX_MAGIC
+#
+# A file without a trailer (its game was killed) is indexed by skipping from
+# record to record.
+
+MAGIC = b"LHRP\x02"
+# Message number format by version byte
+MESSAGE = {1: struct.Struct("<H"), 2: struct.Struct("<I")}
+INDEX_MAGIC = b"LHRI"
+RECORD = struct.Struct("<cI")
+TRAILER = struct.Struct("<Q4s")
+
+OP_PASS, OP_MOVE, OP_ATTACK, OP_CONNECT, OP_JSON = 0, 1, 2, 3, 255
+
+def _is_int(v, lo, hi):
+    return type(v) is int and lo <= v <= hi
+
+def encode_command(move):
+    # Well-formed commands take a few bytes; anything else is kept as JSON
+    cmd = move.get("command")
+    if cmd == "pass":
+        return bytes((OP_PASS,))
+    elif cmd == "move" and _is_int(move.get("x"), -128, 127) and _is_int(move.get("y"), -128, 127):
+        return struct.pack("<Bbb", OP_MOVE, move["x"], move["y"])
+    elif cmd == "attack" and _is_int(move.get("energy"), -2**63, 2**63 - 1):
+        return struct.pack("<Bq", OP_ATTACK, move["energy"])
+    elif cmd == "connect":
+        dest = move.get("destination")
+        if (isinstance(dest, list) and len(dest) == 2 and
+            _is_int(dest[0], 0, 65535) and _is_int(dest[1], 0, 65535)):
+            return struct.pack("<BHH", OP_CONNECT, dest[0], dest[1])
+    data = json.dumps(move).encode("utf-8")
+    return struct.pack("<BI", OP_JSON, len(data)) + data
+
+def decode_command(data):
+    op = data[0]
+    if op == OP_PASS:
+        return {"command": "pass"}, 1
+    elif op == OP_MOVE:
+        op, x, y = struct.unpack_from("<Bbb", data)
+        return {"command": "move", "x": x, "y": y}, 3
+    elif op == OP_ATTACK:
+        op, energy = struct.unpack_from("<Bq", data)
+        return {"command": "attack", "energy": energy}, 9
+    elif op == OP_CONNECT:
+        op, x, y = struct.unpack_from("<BHH", data)
+        return {"command": "connect", "destination": [x, y]}, 5
+    else:
+        op, size = struct.unpack_from("<BI", data)
+        return json.loads(data[5:5 + size].decode("utf-8")), 5 + size
+
+def _lighthouse_order(game):
+    return sorted(game._lh_index, key=game._lh_index.get)
+
+def pack_state(game):
+    index = game._lh_index
+    buf = io.BytesIO()
+    np.savez_compressed(
+        buf,
+        energy=game.island.energy_array().astype(np.uint8),
+        players=np.array([(p.pos[0], p.pos[1], p.score, p.energy)
+                          for p in game.players], dtype=np.int64).reshape(-1, 4),
+        keys=np.array([(p.num, index[pos]) for p in game.players for pos in p.keys],
+                      dtype=np.int32).reshape(-1, 2),
+        lighthouses=np.array([(-1 if lh.owner is None else lh.owner, lh.energy)
+                              for lh in map(game.lighthouses.get, _lighthouse_order(game))],
+                             dtype=np.int64).reshape(-1, 2),
+        conns=np.array([[index[pos] for pos in pair] for pair in game.conns],
+                       dtype=np.int32).reshape(-1, 2),
+        tris=np.array([[index[pos] for pos in tri] for tri in game.tris],
+                      dtype=np.int32).reshape(-1, 3))
+    return buf.getvalue()
+
+def load_state(game, data):
+    # game must be freshly created from the same map
+    state = np.load(io.BytesIO(data))
+    order = _lighthouse_order(game)
+    game.island.load_energy(state["energy"])
+    for player, (x, y, score, energy) in zip(game.players, state["players"].tolist()):
+        player.pos = (x, y)
+        player.score = score
+        player.energy = energy
+        player.keys = set()
+    for num, i in state["keys"].tolist():
+        game.players[num].keys.add(order[i])
+    for pos, (owner, energy) in zip(order, state["lighthouses"].tolist()):
+        lh = game.lighthouses[pos]
+        lh._set_owner(None if owner < 0 else owner)
+        lh.energy = energy
+        game._touch(pos)
+    for a, b in state["conns"].tolist():
+        game._link(frozenset((order[a], order[b])))
+    for tri in state["tris"].tolist():
+        tri = tuple(order[i] for i in tri)
+        game._add_tri(tri, game._tri_cells(tri))
+
+class ReplayWriter(object):
+    KEYFRAME_INTERVAL = 100
+
+    def __init__(self, path, mapfile, game, interval=KEYFRAME_INTERVAL):
+        self.game = game
+        self.interval = interval
+        self.round = 0
+        self._rounds = []
+        self._keyframes = []
+        self._messages = dict()
+        with open(mapfile, "r") as fd:
+            map_data = fd.read()
+        header = zlib.compress(json.dumps({
+            "map": mapfile,
+            "map_data": map_data,
+            "players": len(game.players),
+            "names": [p.name for p in game.players],
+            "keyframe_interval": interval,
+        }).encode("utf-8"))
+        self.fd = open(path, "wb")
+        self.fd.write(MAGIC + struct.pack("<I", len(header)) + header)
+
+    def _record(self, tag, payload):
+        offset = self.fd.tell()
+        self.fd.write(RECORD.pack(tag, len(payload)))
+        self.fd.write(payload)
+        return offset
+
+    def begin_round(self):
+        # Call before pre_round
+        self._rounds.append(self._record(b"R", struct.pack("<I", self.round)))
+        if self.round % self.interval == 0:
+            self._keyframes.append((self.round, self._record(b"K", pack_state(self.game))))
+        self.round += 1
+
+    def turn(self, num, move, result):
+        payload = struct.pack("<BB", num, result["success"]) + encode_command(move)
+        if not result["success"]:
+            message = result["message"]
+            if message not in self._messages:
+                self._messages[message] = len(self._messages)
+                self._record(b"M", message.encode("utf-8"))
+            payload += MESSAGE[MAGIC[-1]].pack(self._messages[message])
+        self._record(b"T", payload)
+
+    def close(self):
+        if self.fd is None:
+            return
+        index = (struct.pack("<II", len(self._rounds), len(self._keyframes)) +
+                 np.array(self._rounds, dtype="<u8").tobytes() +
+                 np.array(self._keyframes, dtype="<u8").reshape(-1, 2).tobytes() +
+                 json.dumps(sorted(self._messages, key=self._messages.get)).encode("utf-8"))
+        offset = self._record(b"I", index)
+        self.fd.write(TRAILER.pack(offset, INDEX_MAGIC))
+        self.fd.close()
+        self.fd = None
+
+class ReplayReader(object):
+    def __init__(self, path):
+        self.fd = open(path, "rb")
+        magic = self.fd.read(len(MAGIC))
+        if magic[:-1] != MAGIC[:-1] or magic[-1] not in MESSAGE:
+            raise engine.GameError("Not a replay file: %r" % path)
+        self._message = MESSAGE[magic[-1]]
+        size, = struct.unpack("<I", self.fd.read(4))
+        self.header = json.loads(zlib.decompress(self.fd.read(size)).decode("utf-8"))
+        self.config = engine.GameConfig.from_text(self.header["map_data"])
+        start = self.fd.tell()
+        if not self._read_index():
+            self._scan(start)
+
+    def _read_index(self):
+        self.fd.seek(0, 2)
+        end = self.fd.tell()
+        if end < TRAILER.size:
+            return False
+        self.fd.seek(end - TRAILER.size)
+        offset, magic = TRAILER.unpack(self.fd.read(TRAILER.size))
+        if magic != INDEX_MAGIC:
+            return False
+        tag, payload = self._read_record(offset)
+        rounds, keyframes = struct.unpack_from("<II", payload)
+        data = np.frombuffer(payload, dtype="<u8", count=rounds + 2 * keyframes, offset=8)
+        self.rounds = data[:rounds].tolist()
+        self.keyframes = data[rounds:].reshape(-1, 2).tolist()
+        self.messages = json.loads(payload[8 + 8 * len(data):].decode("utf-8"))
+        return True
+
+    def _scan(self, offset):
+        self.rounds = []
+        self.keyframes = []
+        self.messages = []
+        self.fd.seek(0, 2)
+        end = self.fd.tell()
+        self.fd.seek(offset)
+        while offset + RECORD.size <= end:
+            tag, size = RECORD.unpack(self.fd.read(RECORD.size))
+            if tag == b"I" or offset + RECORD.size + size > end:
+                break
+            if tag == b"R":
+                self.rounds.append(offset)
+            elif tag == b"K":
+                self.keyframes.append((len(self.rounds) - 1, offset))
+            elif tag == b"M":
+                self.messages.append(self.fd.read(size).decode("utf-8"))
+            offset += RECORD.size + size
+            self.fd.seek(offset)
+
+    def _read_record(self, offset):
+        self.fd.seek(offset)
+        tag, size = RECORD.unpack(self.fd.read(RECORD.size))
+        payload = self.fd.read(size)
+        if len(payload) < size:
+            raise engine.GameError("Replay file is truncated")
+        return tag, payload
+
+    def _records(self, offset):
+        self.fd.seek(offset)
+        while True:
+            head = self.fd.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            tag, size = RECORD.unpack(head)
+            payload = self.fd.read(size)
+            if len(payload) < size or tag == b"I":
+                return
+            yield tag, payload
+
+    def __len__(self):
+        # Number of rounds whose starting state can be rebuilt
+        return len(self.rounds)
+
+    def new_game(self):
+        return engine.Game(self.config, self.header["players"])
+
+    def turns(self, round):
+        # The turns played in a round, as (player, command, result)
+        turns = []
+        records = self._records(self.rounds[round])
+        next(records)
+        for tag, payload in records:
+            if tag == b"R":
+                break
+            elif tag == b"T":
+                turns.append(self._turn(payload))
+        return turns
+
+    def _turn(self, payload):
+        num, success = struct.unpack_from("<BB", payload)
+        move, size = decode_command(payload[2:])
+        if success:
+            result = {"success": True}
+        else:
+            message, = self._message.unpack_from(payload, 2 + size)
+            result = {"success": False, "message": self.messages[message]}
+        return num, move, result
+
+    def game_at(self, round):
+        # State at the start of a round, before its pre_round
+        if not 0 <= round < len(self.rounds):
+            raise IndexError("Round %d is not in the replay" % round)
+        i = bisect.bisect_right([r for r, offset in self.keyframes], round) - 1
+        if i < 0:
+            raise engine.GameError("No keyframe before round %d" % round)
+        start, offset = self.keyframes[i]
+        game = self.new_game()
+        records = self._records(offset)
+        load_state(game, next(records)[1])
+        current = start
+        if current == round:
+            return game
+        game.pre_round()
+        for tag, payload in records:
+            if tag == b"T":
+                num, move, result = self._turn(payload)
+                try:
+                    game.play(game.players[num], move)
+                    ok = True
+                except engine.MoveError:
+                    ok = False
+                if ok != result["success"]:
+                    raise engine.GameError("Replay diverged in round %d" % current)
+            elif tag == b"R":
+                game.post_round()
+                current += 1
+                if current == round:
+                    return game
+                game.pre_round()
+
+    def close(self):
+        self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+import os, unittest
+from unittest import mock
+import engine, batch
+
+MAPS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "maps")
+
+class ConformanceTest(unittest.TestCase):
+    def check(self, mapname, *args):
+        return batch.check(engine.GameConfig(os.path.join(MAPS, mapname)), *args)
+
+    def test_grid(self):
+        stats = self.check("grid.txt", 8, 150)
+        self.assertGreater(stats["connections"], 0)
+        self.assertGreater(stats["triangles"], 0)
+
+    def test_island(self):
+        stats = self.check("island.txt", 8, 150, 2)
+        self.assertGreater(stats["triangles"], 0)
+
+    def test_square(self):
+        stats = self.check("square.txt", 8, 150)
+        self.assertGreater(stats["triangles"], 0)
+
+    def test_mismatch(self):
+        # A rule that differs from engine.Game is caught
+        with mock.patch.object(batch.BatchGame, "DECAY", 11):
+            with self.assertRaises(engine.GameError):
+                self.check("square.txt", 4, 50)
+
+if __name__ == "__main__":
+    unittest.main()
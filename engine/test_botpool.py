@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+import os, shutil, tempfile, unittest
+import botplayer, botpool
+
+# Answers one line with its own pid
+BOT = """import os, sys
+if __name__ == "__main__":
+    sys.stdin.readline()
+    print(os.getpid(), flush=True)
+"""
+
+class ForkServerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        script = os.path.join(self.dir, "bot.py")
+        with open(script, "w") as fd:
+            fd.write(BOT)
+        self.server = botpool.ForkServer("python3 %s" % script)
+        botpool.ChildWatcher().add_server(self.server)
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def talk(self, proc):
+        proc.stdin.write(b"hi\n")
+        proc.stdin.flush()
+        pid = int(proc.stdout.readline())
+        proc.stdin.close()
+        proc.stdout.close()
+        self.assertEqual(proc.wait(5), 0)
+        return pid
+
+    def test_spawn(self):
+        proc = self.server.spawn(5)
+        self.assertEqual(self.talk(proc), proc.pid)
+
+    def test_late_reply(self):
+        # The pid of the abandoned request arrives after spawn() gave up, and
+        # must not be taken for the next child
+        with self.assertRaises(botplayer.CommError):
+            self.server.spawn(0)
+        for i in range(3):
+            proc = self.server.spawn(5)
+            self.assertEqual(self.talk(proc), proc.pid)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+import os, json, unittest
+import engine
+
+MAPS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "maps")
+
+def state(game):
+    # Everything apply() and undo() may touch, in comparable form. The
+    # order of the connections in the lighthouse snapshot does not matter.
+    snapshot = []
+    for pos, (connections, prefix) in sorted(game.lighthouse_snapshot().items()):
+        entry = json.loads(prefix + "0}")
+        entry["connections"].sort()
+        snapshot.append((pos, sorted(connections), sorted(entry.items())))
+    return (
+        game.island.energy_array().tolist(),
+        [(p.pos, p.energy, p.score, sorted(p.keys)) for p in game.players],
+        sorted((pos, lh.owner, lh.energy) for pos, lh in game.lighthouses.items()),
+        sorted(tuple(sorted(pair)) for pair in game.conns),
+        sorted(game.tris),
+        list(game.rates),
+        sorted((pos, sorted(tuple(sorted(pair)) for pair in c)) for pos, c in game._conn_index.items()),
+        sorted((pos, sorted(t)) for pos, t in game._tri_index.items()),
+        snapshot,
+    )
+
+# Player 0 takes three lighthouses and connects them into a triangle, then
+# player 1 takes one of its corners, which drops the triangle. Every round is
+# played both with apply() on the game and with play() on a clone.
+class ApplyUndoTest(unittest.TestCase):
+    TRIANGLE = (9, 9), (13, 9), (13, 13)
+    LAZY = False
+
+    def setUp(self):
+        self.game = engine.Game(engine.GameConfig(os.path.join(MAPS, "grid.txt")), 2,
+                                lazy_energy=self.LAZY)
+        # Enough for the corners to outlast decay while the triangle is
+        # built, and for player 1 to take one of them
+        self.game.players[0].energy = 1000
+        self.game.players[1].energy = 3000
+        self.ref = self.game.clone()
+        # (delta, state before it was applied), in order
+        self.history = []
+
+    def _apply(self, step, *args):
+        before = state(self.game)
+        try:
+            delta = step(*args)
+        except engine.MoveError:
+            self.assertEqual(state(self.game), before)
+            return
+        self.history.append((delta, before))
+
+    def round(self, moves):
+        game, ref = self.game, self.ref
+        self._apply(game.apply_pre_round)
+        ref.pre_round()
+        for player, move in zip(game.players, moves):
+            self._apply(game.apply, player, move)
+            try:
+                ref.play(ref.players[player.num], move)
+            except engine.MoveError:
+                pass
+        self._apply(game.apply_post_round)
+        ref.post_round()
+        self.assertEqual(state(game), state(ref))
+
+    def act(self, num, move):
+        moves = [{"command": "pass"} for p in self.game.players]
+        moves[num] = move
+        self.round(moves)
+
+    def goto(self, num, pos):
+        player = self.game.players[num]
+        while player.pos != pos:
+            dx = (pos[0] > player.pos[0]) - (pos[0] < player.pos[0])
+            dy = (pos[1] > player.pos[1]) - (pos[1] < player.pos[1])
+            self.act(num, {"command": "move", "x": dx, "y": dy})
+        # Picks up the key
+        self.act(num, {"command": "pass"})
+
+    def attack(self, num):
+        self.act(num, {"command": "attack", "energy": self.game.players[num].energy})
+
+    def connect(self, num, dest):
+        self.act(num, {"command": "connect", "destination": list(dest)})
+
+    def build(self):
+        # Connecting uses up the key of the destination, so the first corner
+        # is visited twice
+        a, b, c = self.TRIANGLE
+        self.goto(0, b)
+        self.attack(0)
+        self.goto(0, c)
+        self.attack(0)
+        self.connect(0, b)
+        self.goto(0, a)
+        self.attack(0)
+        self.connect(0, c)
+        self.goto(0, b)
+        self.attack(0)
+        self.connect(0, a)
+
+    def test_triangle(self):
+        self.build()
+        self.assertEqual(len(self.game.conns), 3)
+        self.assertEqual(len(self.game.tris), 1)
+        self.assertEqual(self.game.lighthouses[self.TRIANGLE[0]].owner, 0)
+
+    def test_drop_triangle(self):
+        self.build()
+        self.goto(1, self.TRIANGLE[2])
+        self.attack(1)
+        self.assertEqual(self.game.lighthouses[self.TRIANGLE[2]].owner, 1)
+        self.assertEqual(len(self.game.conns), 1)
+        self.assertEqual(len(self.game.tris), 0)
+
+    def test_undo(self):
+        self.build()
+        self.goto(1, self.TRIANGLE[2])
+        self.attack(1)
+        for delta, before in reversed(self.history):
+            self.game.undo(delta)
+            self.assertEqual(state(self.game), before)
+
+    def test_undo_failed_move(self):
+        self.build()
+        before = state(self.game)
+        with self.assertRaises(engine.MoveError):
+            self.game.apply(self.game.players[0], {"command": "connect", "destination": [9, 13]})
+        self.assertEqual(state(self.game), before)
+
+    def test_clone(self):
+        self.build()
+        before = state(self.game)
+        clone = self.game.clone()
+        self.assertEqual(state(clone), before)
+        self.goto(1, self.TRIANGLE[2])
+        self.attack(1)
+        self.assertEqual(state(clone), before)
+
+class LazyApplyUndoTest(ApplyUndoTest):
+    LAZY = True
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+import random, unittest
+import geom
+
+class OrientTest(unittest.TestCase):
+    def test_orient2d(self):
+        self.assertLess(geom.orient2d((0,0),(0,1),(1,0)), 0)
+        self.assertLess(geom.orient2d((0,1),(1,0),(0,0)), 0)
+        self.assertLess(geom.orient2d((1,0),(0,0),(0,1)), 0)
+        self.assertGreater(geom.orient2d((0,1),(0,0),(1,0)), 0)
+        self.assertGreater(geom.orient2d((1,0),(0,1),(0,0)), 0)
+        self.assertGreater(geom.orient2d((0,0),(1,0),(0,1)), 0)
+
+    def test_intersect(self):
+        self.assertFalse(geom.intersect(((0,0),(2,2)),((4,1),(1,4))))
+        self.assertFalse(geom.intersect(((0,0),(2,2)),((3,1),(1,3))))
+        self.assertTrue(geom.intersect(((0,0),(2,2)),((2,1),(1,2))))
+
+def _random_triangles(count, size=12):
+    rnd = random.Random(1)
+    tris = []
+    while len(tris) < count:
+        tri = tuple((rnd.randrange(size), rnd.randrange(size)) for i in range(3))
+        if not geom.colinear(*tri):
+            tris.append(tri)
+    return tris
+
+class RenderTest(unittest.TestCase):
+    def test_render_mask(self):
+        # The NumPy rasterizer covers exactly the cells of render()
+        tris = [((0,0),(5,0),(0,5)), ((5,5),(5,0),(0,5)), ((1,7),(9,2),(4,4))]
+        for tri in tris + _random_triangles(200):
+            cells = geom.CellMask(*geom.render_mask(tri))
+            self.assertEqual(set(cells), set(geom.render(tri)), tri)
+
+    def test_shared_edges(self):
+        # Cells on an edge shared by two triangles belong to exactly one
+        a, b, c, d = (0,0), (8,0), (8,8), (0,8)
+        first = set(geom.render((a, b, c)))
+        second = set(geom.render((a, c, d)))
+        self.assertEqual(first & second, set())
+        for i in range(1, 8):
+            self.assertIn((i, i), first | second)
+
+    def test_cell_mask(self):
+        cells = geom.CellMask(*geom.render_mask(((1,7),(9,2),(4,4))))
+        rendered = set(geom.render(((1,7),(9,2),(4,4))))
+        self.assertEqual(len(cells), len(rendered))
+        for x in range(-1, 11):
+            for y in range(-1, 9):
+                self.assertEqual((x, y) in cells, (x, y) in rendered)
+
+class SegmentGridTest(unittest.TestCase):
+    def test_candidates(self):
+        # Every segment crossing the query is a candidate
+        rnd = random.Random(2)
+        grid = geom.SegmentGrid(4)
+        segments = dict()
+        for key in range(100):
+            seg = (rnd.randrange(30), rnd.randrange(30)), (rnd.randrange(30), rnd.randrange(30))
+            segments[key] = seg
+            grid.add(key, *seg)
+        for key in range(0, 100, 3):
+            grid.remove(key)
+            del segments[key]
+        for i in range(200):
+            query = (rnd.randrange(30), rnd.randrange(30)), (rnd.randrange(30), rnd.randrange(30))
+            crossing = set(k for k, seg in segments.items() if geom.intersect(seg, query))
+            self.assertLessEqual(crossing, grid.candidates(*query))
+
+if __name__ == "__main__":
+    unittest.main()
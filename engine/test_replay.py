@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+import os, shutil, tempfile, unittest
+import engine, replay
+
+MAPS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "maps")
+
+# Failed turns refer to their error message by number; a bot can make a game
+# produce more distinct messages than fit in 16 bits.
+class MessageTest(unittest.TestCase):
+    MESSAGES = 70000
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "game.lhr")
+        mapfile = os.path.join(MAPS, "grid.txt")
+        game = engine.Game(engine.GameConfig(mapfile), 2)
+        writer = replay.ReplayWriter(self.path, mapfile, game)
+        writer.begin_round()
+        move = {"command": "fly"}
+        for n in range(self.MESSAGES):
+            writer.turn(n % 2, move, {"success": False, "message": "Unknown command %d" % n})
+        writer.turn(0, move, {"success": False, "message": "Unknown command 0"})
+        self.writer = writer
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self):
+        with replay.ReplayReader(self.path) as r:
+            self.assertEqual(len(r.messages), self.MESSAGES)
+            turns = r.turns(0)
+        self.assertEqual(len(turns), self.MESSAGES + 1)
+        for n in (0, 65535, 65536, self.MESSAGES - 1):
+            self.assertEqual(turns[n], (n % 2, {"command": "fly"},
+                                        {"success": False, "message": "Unknown command %d" % n}))
+        self.assertEqual(turns[-1][2]["message"], "Unknown command 0")
+
+    def test_indexed(self):
+        self.writer.close()
+        self.check()
+
+    def test_unindexed(self):
+        # Killed game: no index, the reader scans the records
+        self.writer.fd.close()
+        self.check()
+
+if __name__ == "__main__":
+    unittest.main()
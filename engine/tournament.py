@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+
+import os, sys, json, itertools, argparse, multiprocessing
+import botplayer, botpool, multiplex, liveview, mapcache, metrics, matchplay
+
+_botpool = None
+
+def _init_worker(warm, fork_server, bots, cpu_timeouts=False, cpu_sets=None, counter=None,
+                 wall_cap=None):
+    global _botpool
+    botplayer.BotPlayer.CPU_TIMEOUTS = cpu_timeouts
+    if wall_cap is not None:
+        botplayer.BotPlayer.WALL_CAP_FACTOR = wall_cap
+    if cpu_sets:
+        with counter.get_lock():
+            index = counter.value
+            counter.value += 1
+        # Bots, including warm ones and the fork server, inherit the affinity
+        os.sched_setaffinity(0, cpu_sets[index % len(cpu_sets)])
+    if warm:
+        _botpool = botpool.BotPool(warm, fork_server)
+        for cmdline in bots:
+            if botplayer.spawns_process(cmdline):
+                _botpool.prewarm(cmdline)
+
+def cpu_sets(jobs=None):
+    # Splits the CPUs this process may use into one set per worker. With more
+    # workers than CPUs, workers share single CPUs.
+    cpus = sorted(os.sched_getaffinity(0))
+    jobs = min(jobs or len(cpus), len(cpus))
+    size = len(cpus) // jobs
+    sets = [cpus[i * size:(i + 1) * size] for i in range(jobs)]
+    sets[-1] += cpus[jobs * size:]
+    return sets
+
+def run_match(mapfile, bots, rounds, lazy_energy=False, pool=None, view=None, instrument=False):
+    m = matchplay.Match(mapfile, bots, rounds, lazy_energy, instrument)
+    if view is not None:
+        view.watch(m.game)
+    def make(game, i, cmdline):
+        if pool is not None and botplayer.spawns_process(cmdline):
+            return botpool.PooledBotPlayer(game, i, cmdline, pool)
+        return botplayer.make_player(game, i, cmdline)
+    try:
+        m.seat(make, botplayer.DeadPlayer)
+        m.run(view)
+    finally:
+        for actor in m.actors:
+            actor.close()
+    if pool is not None:
+        pooled = [a for a in m.actors if isinstance(a, botpool.PooledBotPlayer)]
+        # Bots are reaped concurrently; this waits for the slowest one
+        pool.wait([a.record for a in pooled])
+        m.result["lifecycle"] = [a.lifecycle() if a in pooled else None for a in m.actors]
+    return m.finish()
+
+def _play(args):
+    mapfile, bots, rounds, lazy_energy, instrument = args
+    try:
+        return run_match(mapfile, bots, rounds, lazy_energy, _botpool, instrument=instrument)
+    except Exception as e:
+        return {"map": mapfile, "bots": list(bots), "rounds": rounds,
+                "failed": "%s: %s" % (type(e).__name__, e)}
+
+def _play_batch(args):
+    tasks, concurrency = args
+    return multiplex.run_matches(tasks, concurrency)
+
+# Every set of `players` bots meets on every map. Start positions and turn
+# order go by seat, so by default each set plays once per seat order; with
+# seat_orders False it plays once, with bots seated in the order given, which
+# always favours the same bots.
+def schedule(maps, bots, players=2, seat_orders=True):
+    matches = itertools.permutations if seat_orders else itertools.combinations
+    for mapfile in maps:
+        for match in matches(bots, players):
+            yield mapfile, match
+
+def summarize(matches):
+    totals = dict()
+    for m in matches:
+        for i, bot in enumerate(m["bots"]):
+            t = totals.setdefault(bot, {"matches": 0, "score": 0, "errors": 0})
+            t["matches"] += 1
+            if "failed" in m:
+                t["errors"] += 1
+                continue
+            t["score"] += m["scores"][i]
+            if m["errors"][i] is not None:
+                t["errors"] += 1
+    return {"matches": matches, "bots": totals}
+
+def run_tournament(maps, bots, rounds, players=2, jobs=None, lazy_energy=False,
+                   concurrency=0, warm=0, fork_server=False, watch=False,
+                   metrics_json=None, metrics_prom=None, metrics_interval=None,
+                   cpu_timeouts=False, pin=False, seat_orders=True, wall_cap=None):
+    # With a metrics file, every match is instrumented and its report merged
+    # here as it finishes; the files are rewritten every metrics_interval
+    # seconds and at the end.
+    instrument = metrics_json is not None or metrics_prom is not None
+    stats = metrics.Metrics(metrics_json, metrics_prom, metrics_interval) if instrument else None
+    tasks = [(mapfile, match, rounds, lazy_energy, instrument)
+             for mapfile, match in schedule(maps, bots, players, seat_orders)]
+    # Compile the maps once here; the workers inherit them already mapped
+    for mapfile in set(maps):
+        mapcache.load(mapfile)
+    # With pin, every worker, so every match it plays, gets its own CPUs
+    initargs = (max(warm, 1) if warm or fork_server else 0, fork_server, bots, cpu_timeouts,
+                cpu_sets(jobs) if pin else None, multiprocessing.Value("i", 0), wall_cap)
+    botplayer.BotPlayer.CPU_TIMEOUTS = cpu_timeouts
+    if wall_cap is not None:
+        botplayer.BotPlayer.WALL_CAP_FACTOR = wall_cap
+    # The watched match runs in this process, alongside the workers. Its
+    # viewer is forked before the pool starts any threads.
+    watched = None
+    if watch and tasks:
+        watched = tasks.pop(0)
+        view = liveview.LiveView()
+    matches = []
+    def finished(match):
+        report = match.pop("metrics", None)
+        if report is not None:
+            stats.merge(report)
+            stats.tick()
+        matches.append(match)
+    with multiprocessing.Pool(jobs, _init_worker, initargs) as pool:
+        if concurrency:
+            batches = [(tasks[i:i+concurrency], concurrency)
+                       for i in range(0, len(tasks), concurrency)]
+            pending = pool.imap_unordered(_play_batch, batches)
+        else:
+            pending = pool.imap_unordered(_play, tasks)
+        if watched is not None:
+            mapfile, match, rounds, lazy_energy, instrument = watched
+            try:
+                finished(run_match(mapfile, match, rounds, lazy_energy, view=view,
+                                   instrument=instrument))
+            except Exception as e:
+                finished({"map": mapfile, "bots": list(match), "rounds": rounds,
+                          "failed": "%s: %s" % (type(e).__name__, e)})
+            view.close()
+        for result in pending:
+            for match in (result if concurrency else [result]):
+                finished(match)
+    if stats is not None:
+        stats.export()
+    matches.sort(key=lambda m: (m["map"], m["bots"]))
+    return summarize(matches)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run a headless round-robin tournament")
+    parser.add_argument("--maps", nargs="+", required=True, help="map files")
+    parser.add_argument("--bots", nargs="+", required=True, help="bot command lines")
+    parser.add_argument("-r", "--rounds", type=int, default=1000, help="rounds per match")
+    parser.add_argument("-p", "--players", type=int, default=2, help="bots per match")
+    parser.add_argument("--one-order", dest="seat_orders", action="store_false",
+                        help="play each set of bots once, seated in the order given, "
+                             "instead of once per seat order")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("-c", "--concurrency", type=int, default=0,
+                        help="matches multiplexed on one event loop per worker "
+                             "(default: one match per worker)")
+    parser.add_argument("-w", "--warm", type=int, default=0,
+                        help="idle bot processes kept ready per command line in each worker")
+    parser.add_argument("--fork-server", action="store_true",
+                        help="fork 'python3 bot.py' bots from a preloaded fork server")
+    parser.add_argument("-o", "--output", default="-", help="JSON summary file")
+    parser.add_argument("--lazy-energy", action="store_true",
+                        help="use the lazily evaluated energy backend")
+    parser.add_argument("--watch", action="store_true",
+                        help="show the first match live while the tournament runs")
+    parser.add_argument("--cpu-timeouts", action="store_true",
+                        help="judge bot timeouts on the CPU time they used, not wall time")
+    parser.add_argument("--wall-cap", type=float, default=None, metavar="FACTOR",
+                        help="with --cpu-timeouts, longest wall time a reply may take, as a "
+                             "multiple of its hard timeout (default: %g)"
+                             % botplayer.BotPlayer.WALL_CAP_FACTOR)
+    parser.add_argument("--pin", action="store_true",
+                        help="give every worker, its matches and their bots a dedicated set of CPUs")
+    parser.add_argument("--metrics-json", default=None,
+                        help="write phase latencies and bot error counts to this JSON file")
+    parser.add_argument("--metrics-prom", default=None,
+                        help="write the same metrics in Prometheus text format")
+    parser.add_argument("--metrics-interval", type=float, default=None,
+                        help="also rewrite the metrics files every this many seconds")
+    args = parser.parse_args(argv)
+    if not 1 <= args.players <= len(args.bots):
+        parser.error("--players must be between 1 and the number of bots")
+    if args.concurrency and (args.warm or args.fork_server):
+        parser.error("--warm and --fork-server do not apply to multiplexed matches")
+
+    summary = run_tournament(args.maps, args.bots, args.rounds, args.players,
+                             args.jobs, args.lazy_energy, args.concurrency,
+                             args.warm, args.fork_server, args.watch,
+                             args.metrics_json, args.metrics_prom, args.metrics_interval,
+                             args.cpu_timeouts, args.pin, args.seat_orders, args.wall_cap)
+    if args.output == "-":
+        json.dump(summary, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as fd:
+            json.dump(summary, fd, indent=1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 import pygame, sys, time, math
+import numpy as np
 
 CELL = 15
 
@@ -24,7 +25,18 @@ class GameView(object):
         self.fw = self.game.island.w * CELL * self.scale
         self.fh = self.game.island.h * CELL * self.scale
         self.arena = pygame.Surface((self.fw, self.fh), 0, self.screen)
+        self.arena.fill((0, 0, 0))
         self.nh = self.game.island.h - 1
+        # What each cell looked like when it was last drawn, so that update()
+        # only redraws cells that changed. _stacks[x, y] lists the triangles
+        # covering a cell; their tints are blended in game.tris order (_rank).
+        self._stacks = dict()
+        self._rank = dict()
+        self._shade = None
+        self._occupants = dict()
+        self._lh_owners = dict()
+        self._tris = dict()
+        self._conns = set()
 
     def _afill(self, pos, size, c):
         x0, y0 = pos
@@ -77,15 +89,13 @@ class GameView(object):
         c = int(self.game.island.energy[cx, cy] / 100.0 * 25)
         bg = tuple(map(int,(25+c*0.8, 25+c*0.8, 25+c)))
 
-        for vertices, fill in self.game.tris.items():
-            if (cx, cy) in fill:
-                owner = self.game.lighthouses[vertices[0]].owner
-                bg = self.calpha(bg, PLAYERC[owner], 0.15)
+        for tri in sorted(self._stacks.get((cx, cy), ()), key=self._rank.get):
+            bg = self.calpha(bg, PLAYERC[self._tris[tri][0]], 0.15)
 
         self._afill((px, py), (CELL, CELL), bg)
         self._afill((px + CELL//2, py + CELL//2), (1,1), (255,255,255))
 
-        cplayers = [i for i in self.game.players if i.pos == (cx, cy)]
+        cplayers = self._occupants.get((cx, cy), [])
         if cplayers:
             nx = int(math.ceil(math.sqrt(len(cplayers))))
             wx = (CELL - 4) / nx
@@ -106,12 +116,80 @@ class GameView(object):
                 color = PLAYERC[lh.owner]
             self._diamond((px + CELL//2, py + CELL//2), 4, color, 0)
 
+    def _cover(self, tri, cells, dirty, add):
+        (x0, y0), mask = cells.origin, cells.mask
+        h, w = mask.shape
+        for y, x in zip(*np.nonzero(mask)):
+            pos = x0 + int(x), y0 + int(y)
+            if add:
+                self._stacks.setdefault(pos, []).append(tri)
+            else:
+                stack = self._stacks[pos]
+                stack.remove(tri)
+                if not stack:
+                    del self._stacks[pos]
+        dirty[y0:y0+h, x0:x0+w] |= mask
+
+    def _dirty_cells(self):
+        game = self.game
+        shade = (game.island.energy_array() / 100.0 * 25).astype(int)
+        if self._shade is None:
+            dirty = np.ones(shade.shape, dtype=bool)
+        else:
+            dirty = shade != self._shade
+        self._shade = shade
+
+        occupants = dict()
+        for player in game.players:
+            occupants.setdefault(player.pos, []).append(player)
+        for pos in set(occupants) | set(self._occupants):
+            if occupants.get(pos) != self._occupants.get(pos):
+                dirty[pos[1], pos[0]] = True
+        self._occupants = occupants
+
+        for pos, lh in game.lighthouses.items():
+            if self._lh_owners.get(pos, -1) != lh.owner:
+                self._lh_owners[pos] = lh.owner
+                dirty[pos[1], pos[0]] = True
+
+        for tri in list(self._tris):
+            owner, cells = self._tris[tri]
+            if game.tris.get(tri) is not cells:
+                self._cover(tri, cells, dirty, False)
+                del self._tris[tri]
+        # Tint blending does not commute, so if the kept triangles changed
+        # order (an undo can put one back at the end) all their cells change
+        rank = dict((tri, i) for i, tri in enumerate(game.tris))
+        kept = sorted(self._tris, key=self._rank.get)
+        if kept != sorted(kept, key=rank.get):
+            for owner, cells in self._tris.values():
+                (x0, y0), mask = cells.origin, cells.mask
+                h, w = mask.shape
+                dirty[y0:y0+h, x0:x0+w] |= mask
+        self._rank = rank
+        for tri, cells in game.tris.items():
+            if tri not in self._tris:
+                owner = game.lighthouses[tri[0]].owner
+                self._tris[tri] = owner, cells
+                self._cover(tri, cells, dirty, True)
+
+        # Cells under removed connections must be redrawn to erase the line
+        for (x0, y0), (x1, y1) in self._conns - game.conns:
+            x0, x1 = sorted((x0, x1))
+            y0, y1 = sorted((y0, y1))
+            dirty[y0:y1+1, x0:x1+1] = True
+        self._conns = set(game.conns)
+
+        return dirty
+
     def update(self):
-        self.arena.fill((0, 0, 0))
-        for cy in range(self.game.island.h):
-            for cx in range(self.game.island.w):
-                if self.game.island[cx, cy]:
-                    self.draw_cell((cx, cy))
+        land = self.game.island.mask
+        for cy, cx in zip(*np.nonzero(self._dirty_cells())):
+            cx, cy = int(cx), int(cy)
+            if land[cy, cx]:
+                self.draw_cell((cx, cy))
+            else:
+                self._afill((cx * CELL, (self.nh - cy) * CELL), (CELL, CELL), (0, 0, 0))
         for (x0, y0), (x1, y1) in self.game.conns:
             owner = self.game.lighthouses[x0, y0].owner
             color = PLAYERC[owner]
@@ -1,7 +1,7 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import sys, json
+import sys, os, json, socket, threading
 
 # ==============================================================================
 # ROBOT
@@ -23,7 +23,7 @@ class Bot(object):
         self.player_count = init_state["player_count"]
         self.init_pos = init_state["position"]
         self.map = init_state["map"]
-        self.lighthouses = map(tuple, init_state["lighthouses"])
+        self.lighthouses = list(map(tuple, init_state["lighthouses"]))
 
     def play(self, state):
         """Jugar: llamado cada turno.
@@ -49,7 +49,7 @@ class Bot(object):
 
     def log(self, message, *args):
         """Mostrar mensaje de registro por stderr"""
-        print >>sys.stderr, "[%s] %s" % (self.NAME, (message % args))
+        sys.stderr.write("[%s] %s\n" % (self.NAME, (message % args)))
 
     # ==========================================================================
     # Jugadas posibles
@@ -99,26 +99,58 @@ class Bot(object):
 # ==============================================================================
 
 class Interface(object):
-    def __init__(self, bot_class):
+    # Pedir al motor que sólo envíe los faros que han cambiado desde el turno
+    # anterior. El estado completo se reconstruye aquí antes de llamar al bot.
+    DELTA = True
+
+    def __init__(self, bot_class, rfile=None, wfile=None):
         self.bot_class = bot_class
         self.bot = None
+        self.lighthouses = []
+        self.lh_index = {}
+        self.rfile = rfile or sys.stdin
+        self.wfile = wfile or sys.stdout
     
     def _recv(self):
-        line = sys.stdin.readline()
+        line = self.rfile.readline()
         if not line:
-            sys.exit(0)
+            raise EOFError()
         return json.loads(line)
 
     def _send(self, msg):
-        sys.stdout.write(json.dumps(msg) + "\n")
-        sys.stdout.flush()
+        self.wfile.write(json.dumps(msg) + "\n")
+        self.wfile.flush()
+
+    def _merge(self, state):
+        for lh in state["lighthouses"]:
+            pos = tuple(lh["position"])
+            if pos in self.lh_index:
+                self.lighthouses[self.lh_index[pos]] = lh
+            else:
+                self.lh_index[pos] = len(self.lighthouses)
+                self.lighthouses.append(lh)
+        state["lighthouses"] = list(self.lighthouses)
+        return state
 
     def run(self):
+        """Jugar una partida completa. Termina cuando el motor cierra la
+        conexión."""
+        try:
+            self._play()
+        except EOFError:
+            pass
+
+    def _play(self):
         init = self._recv()
         self.bot = self.bot_class(init)
-        self._send({"name": self.bot.NAME})
+        greeting = {"name": self.bot.NAME}
+        if self.DELTA:
+            greeting["capabilities"] = ["delta"]
+        self._send(greeting)
         while True:
             state = self._recv()
+            if self.DELTA:
+                state = self._merge(state)
             move = self.bot.play(state)
             self._send(move)
             status = self._recv()
@@ -127,6 +159,72 @@ class Interface(object):
             else:
                 self.bot.error(status["message"], move)
 
+# ==============================================================================
+# Servidor
+# El motor puede conectarse a un bot ya arrancado en lugar de lanzar un proceso
+# nuevo por partida: pasar "tcp:host:puerto" o "unix:/ruta" como comando del bot.
+# ==============================================================================
+
+def _parse_address(address):
+    if address.startswith("tcp:"):
+        host, port = address[4:].rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    elif address.startswith("unix:"):
+        return socket.AF_UNIX, address[5:]
+    raise ValueError("Dirección no válida: %r" % address)
+
+def _session(bot_class, conn, interface_class):
+    rfile = conn.makefile("r")
+    wfile = conn.makefile("w")
+    try:
+        interface_class(bot_class, rfile, wfile).run()
+    except Exception as e:
+        sys.stderr.write("[%s] Error en la sesión: %r\n" % (bot_class.NAME, e))
+    finally:
+        for f in (rfile, wfile, conn):
+            try:
+                f.close()
+            except Exception:
+                pass
+
+def serve(bot_class, address, fork=False, interface_class=Interface):
+    """Atender partidas indefinidamente en address ("tcp:host:puerto" o
+    "unix:/ruta"). Cada conexión es una partida nueva, que empieza con el
+    mensaje de inicio.
+
+    Por defecto cada partida se atiende en un hilo, por lo que las partidas
+    comparten el proceso (y cualquier precálculo global del bot). Con
+    fork=True cada partida se juega en un proceso hijo.
+    """
+    family, addr = _parse_address(address)
+    if family == socket.AF_UNIX and os.path.exists(addr):
+        os.unlink(addr)
+    srv = socket.socket(family, socket.SOCK_STREAM)
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(addr)
+    srv.listen(128)
+    if fork:
+        import signal
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        conn, peer = srv.accept()
+        if family == socket.AF_INET:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if fork:
+            if os.fork() == 0:
+                srv.close()
+                _session(bot_class, conn, interface_class)
+                os._exit(0)
+            conn.close()
+        else:
+            t = threading.Thread(target=_session,
+                                 args=(bot_class, conn, interface_class))
+            t.daemon = True
+            t.start()
+
 if __name__ == "__main__":
-    iface = Interface(Bot)
-    iface.run()
+    if len(sys.argv) > 1:
+        serve(Bot, sys.argv[1])
+    else:
+        iface = Interface(Bot)
+        iface.run()
@@ -49,5 +49,9 @@ class RandBot(interface.Bot):
         return self.move(*move)
 
 if __name__ == "__main__":
-    iface = interface.Interface(RandBot)
-    iface.run()
+    if len(sys.argv) > 1:
+        # Servidor persistente: randbot.py tcp:127.0.0.1:9000
+        interface.serve(RandBot, sys.argv[1])
+    else:
+        iface = interface.Interface(RandBot)
+        iface.run()
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import numpy as np
+import interface
+
+# ==============================================================================
+# TABLAS DEL MAPA
+# Distancias y movimientos precalculados a partir del mensaje de inicio, para
+# que play() no tenga que buscar caminos durante el turno.
+# ==============================================================================
+
+# Movimientos posibles, en el orden de las tablas de movimientos
+MOVES = ((-1,-1),(-1,0),(-1,1),(0,-1),(0,1),(1,-1),(1,0),(1,1))
+
+class MapTables(object):
+    """Distancias (en movimientos) y caminos sobre el mapa.
+
+    Para cada faro se calcula un campo de distancias a todas las casillas con
+    un BFS en NumPy (se expande todo el frente de cada distancia a la vez)
+    sobre un array plano del mapa, rodeado de un borde de agua. Los campos se
+    guardan con 16 bits por casilla (32 si el mapa tiene tanta tierra que no
+    caben las distancias). De ellos salen la tabla de distancias entre todos
+    los pares de faros y la del primer movimiento de cada faro hacia cada otro.
+
+    El constructor calcula los campos empezando por los faros más cercanos a
+    origin, durante como mucho budget segundos (sin límite si es None). Los
+    que no caben se calculan con build() en turnos posteriores (un BFS
+    interrumpido continúa donde se quedó). Las consultas nunca calculan nada:
+    mientras falta el campo de un faro, distance() devuelve None y next_move()
+    un movimiento en línea recta (ver ready()).
+    """
+
+    def __init__(self, island_map, lighthouses, origin=None, budget=None):
+        deadline = None if budget is None else time.time() + budget
+        self.h = len(island_map)
+        self.w = len(island_map[0])
+        stride = self._stride = self.w + 2
+        self.lighthouses = [tuple(pos) for pos in lighthouses]
+        self.index = dict((pos, i) for i, pos in enumerate(self.lighthouses))
+        n = len(self.lighthouses)
+        land = np.zeros((self.h + 2, stride), dtype=bool)
+        land[1:-1, 1:-1] = np.array(island_map, dtype=bool)
+        self._land = land.ravel()
+        # Valores especiales de los campos: _unreachable en tierra aún no
+        # alcanzada (y al acabar, sin camino) y _water en el agua y el borde
+        dtype = np.uint16 if self._land.sum() < 0xFFFE else np.uint32
+        self._unreachable = np.iinfo(dtype).max
+        self._water = self._unreachable - 1
+        self._empty = np.where(self._land, self._unreachable, self._water).astype(dtype)
+        self._offsets = np.array([dy * stride + dx for dx, dy in MOVES])
+        # Para quitar repetidos del frente sin ordenarlo
+        self._slot = np.zeros(len(self._land), dtype=np.int64)
+        self._cells = np.array([self._cell(pos) for pos in self.lighthouses], dtype=np.int64)
+        self._fields = [None] * n
+        # _pairs[i, j]: distancia entre los faros i y j, válida cuando está
+        # el campo de i o el de j. _hops[i, j]: índice en MOVES del primer
+        # movimiento de i hacia j (-1 si no hay), válido cuando está el campo
+        # de j.
+        self._pairs = np.full((n, n), self._unreachable, dtype=dtype)
+        self._hops = np.full((n, n), -1, dtype=np.int8)
+        # Faros sin campo, en el orden en que se calculan, y el BFS en curso
+        self._pending = list(range(n))
+        self._search = None
+        if origin is not None:
+            ox, oy = origin
+            self._pending.sort(key=lambda i: max(abs(self.lighthouses[i][0] - ox),
+                                                 abs(self.lighthouses[i][1] - oy)))
+        self._build(deadline)
+
+    @property
+    def complete(self):
+        """True si ya están todos los campos."""
+        return not self._pending
+
+    def build(self, budget=None):
+        """Calcular campos pendientes durante como mucho budget segundos.
+        Devuelve True si ya están todos."""
+        self._build(None if budget is None else time.time() + budget)
+        return self.complete
+
+    def _build(self, deadline):
+        while self._pending:
+            field = self._bfs(self._pending[0], deadline)
+            if field is None:
+                break
+            self._add_field(self._pending[0], field)
+
+    def ready(self, lighthouse):
+        """True si el campo del faro ya está calculado, y con él las
+        consultas sobre el faro son exactas."""
+        return self._fields[self.index[tuple(lighthouse)]] is not None
+
+    def _cell(self, pos):
+        x, y = pos
+        if 0 <= x < self.w and 0 <= y < self.h:
+            return (y + 1) * self._stride + x + 1
+        return None
+
+    def _bfs(self, i, deadline=None):
+        # Campo de distancias del faro i, o None si se pasa el deadline. En
+        # ese caso el BFS queda en _search, y la siguiente llamada para el
+        # mismo faro sigue desde ahí.
+        if self._search is not None and self._search[0] == i:
+            i, dist, frontier, d = self._search
+            self._search = None
+        else:
+            dist = self._empty.copy()
+            dist[self._cells[i]] = 0
+            frontier = self._cells[i:i+1]
+            d = 0
+        offsets, unreachable, slot = self._offsets, self._unreachable, self._slot
+        while len(frontier):
+            if deadline is not None and time.time() >= deadline:
+                self._search = (i, dist, frontier, d)
+                return None
+            d += 1
+            reached = (frontier[:, None] + offsets).ravel()
+            reached = reached[dist[reached] == unreachable]
+            dist[reached] = d
+            # Una casilla puede alcanzarse desde varias del frente: de cada
+            # valor repetido queda la posición que se escribió la última
+            order = np.arange(len(reached))
+            slot[reached] = order
+            frontier = reached[slot[reached] == order]
+        return dist
+
+    def _add_field(self, j, field):
+        self._fields[j] = field
+        self._pending.remove(j)
+        self._pairs[:, j] = self._pairs[j, :] = field[self._cells]
+        self._hops[:, j] = self._steps(field, self._cells)
+
+    def _steps(self, field, cells):
+        # Índice en MOVES de una casilla vecina un movimiento más cerca, o -1,
+        # para cada casilla
+        d = field[cells].astype(np.int64)
+        closer = field[cells[:, None] + self._offsets] == (d - 1)[:, None]
+        steps = np.argmax(closer, axis=1)
+        steps[(d == 0) | (d >= self._water) | ~closer.any(axis=1)] = -1
+        return steps
+
+    def field(self, lighthouse):
+        """Campo de distancias del faro, o None si aún no está calculado."""
+        return self._fields[self.index[tuple(lighthouse)]]
+
+    def distance(self, pos, lighthouse):
+        """Movimientos desde pos (faro o casilla cualquiera) hasta el faro, o
+        None si no se puede llegar o si aún no se sabe (ver ready())."""
+        pos = tuple(pos)
+        j = self.index[tuple(lighthouse)]
+        i = self.index.get(pos)
+        if i is not None:
+            if self._fields[i] is None and self._fields[j] is None:
+                return None
+            d = self._pairs[i, j]
+        else:
+            cell = self._cell(pos)
+            if cell is None or self._fields[j] is None:
+                return None
+            d = self._fields[j][cell]
+        return None if d >= self._water else int(d)
+
+    def next_move(self, pos, lighthouse):
+        """Primer movimiento (dx, dy) de un camino más corto desde pos hasta
+        el faro, o None si ya se está en él o no se puede llegar. Mientras no
+        está el campo del faro, el paso en línea recta hacia él, si cae en
+        tierra."""
+        pos = tuple(pos)
+        j = self.index[tuple(lighthouse)]
+        field = self._fields[j]
+        if field is None:
+            dx = (lighthouse[0] > pos[0]) - (lighthouse[0] < pos[0])
+            dy = (lighthouse[1] > pos[1]) - (lighthouse[1] < pos[1])
+            cell = self._cell((pos[0] + dx, pos[1] + dy))
+            if (dx, dy) == (0, 0) or cell is None or not self._land[cell]:
+                return None
+            return dx, dy
+        i = self.index.get(pos)
+        if i is not None:
+            k = self._hops[i, j]
+        else:
+            cell = self._cell(pos)
+            k = -1 if cell is None else self._steps(field, np.array([cell]))[0]
+        return None if k < 0 else MOVES[k]
+
+# ==============================================================================
+# ROBOT
+# Bot base con las tablas del mapa calculadas en la inicialización.
+# ==============================================================================
+
+class Bot(interface.Bot):
+    """Bot base con self.tables (MapTables) listo para usar en play().
+
+    Los campos que no caben en INIT_BUDGET se siguen calculando después de
+    cada jugada, TURN_BUDGET segundos cada vez, mientras el motor atiende al
+    resto de bots. Las subclases que redefinan success() o error() deben
+    llamar a las de esta clase."""
+
+    # Segundos para las tablas. El motor espera el saludo INIT_TIMEOUT (2 s)
+    # desde que envía el mensaje de inicio, que también hay que leer, y cada
+    # jugada MOVE_TIMEOUT (0.1 s).
+    INIT_BUDGET = 1.0
+    TURN_BUDGET = 0.05
+
+    def __init__(self, init_state):
+        interface.Bot.__init__(self, init_state)
+        self.tables = MapTables(self.map, self.lighthouses,
+                                tuple(self.init_pos), self.INIT_BUDGET)
+
+    def success(self):
+        interface.Bot.success(self)
+        self.tables.build(self.TURN_BUDGET)
+
+    def error(self, message, last_move):
+        interface.Bot.error(self, message, last_move)
+        self.tables.build(self.TURN_BUDGET)